@@ -0,0 +1,87 @@
+import select
+import socket
+
+RED = 'RED'
+YELLOW = 'YEL'
+GREEN = 'GRN'
+
+
+class AlertClient():
+    TIMEOUT = 10
+
+    def __init__(self, host, port, timeout=TIMEOUT):
+        self._host = host
+        self._port = int(port)
+        self._timeout = timeout
+
+        self._socket = None
+        self._responses = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def send(self, color, message):
+        return self.send_many([(color, message)])[0]
+
+    def send_many(self, alerts):
+        # Send all the alerts in one go, then collect the acknowledgements,
+        # which come back in the same order
+        if len(alerts) == 0:
+            return list()
+
+        data = ''.join(f'{color} {" ".join(message.splitlines())}\n' for color, message in alerts).encode('utf-8')
+
+        if self._socket is not None and self._dropped():
+            self.close()
+
+        try:
+            self._connect()
+            sent = self._socket.send(data)
+        except OSError:
+            # Nothing has been sent yet, so it's safe to retry once on a new connection
+            self.close()
+            self._connect()
+            sent = self._socket.send(data)
+
+        try:
+            self._socket.sendall(data[sent:])
+            return self._read_responses(len(alerts))
+        except OSError:
+            # Some of the alerts may have been received, so resending could
+            # raise them twice. Leave it to the caller.
+            self.close()
+            raise
+
+    def close(self):
+        if self._socket is not None:
+            self._responses.close()
+            self._socket.close()
+            self._socket = None
+            self._responses = None
+
+    def _connect(self):
+        if self._socket is None:
+            self._socket = socket.create_connection((self._host, self._port), timeout=self._timeout)
+            self._responses = self._socket.makefile('r', encoding='utf-8')
+
+    def _dropped(self):
+        # The server only writes in reply to alerts, so an idle connection
+        # that's readable has been closed
+        try:
+            readable, _, _ = select.select([self._socket], [], [], 0)
+            return len(readable) > 0 and self._socket.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    def _read_responses(self, count):
+        responses = list()
+        for i in range(count):
+            response = self._responses.readline()
+            if response == '':
+                raise ConnectionError('Alert server closed the connection')
+            responses.append(response.strip())
+
+        return responses
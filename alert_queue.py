@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta
+import heapq
+from itertools import count
+from threading import Lock
+
+
+class _QueuedAlert():
+    __slots__ = ('severity', 'color', 'message', 'alert_time', 'last_time', 'expiry', 'repeats', 'seq')
+
+    def __init__(self, severity, color, message, alert_time, expiry, seq):
+        self.severity = severity
+        self.color = color
+        self.message = message
+        # The first occurrence orders the alert, the latest one says how
+        # long it's still worth showing
+        self.alert_time = alert_time
+        self.last_time = alert_time
+        self.expiry = expiry
+        self.repeats = 1
+        self.seq = seq
+
+
+class AlertQueue():
+    # Alerts come out most severe first, then oldest first. Repeats of an
+    # alert that is already waiting are merged into it, and the queue holds
+    # at most max_size distinct alerts.
+
+    def __init__(self, max_size, timeout):
+        self._max_size = max_size
+        self._timeout = timedelta(seconds=timeout)
+
+        self._alerts = dict()
+        self._priority = list()
+        self._expiry = list()
+        self._seq = count()
+        self._lock = Lock()
+
+    def __len__(self):
+        with self._lock:
+            self._expire()
+            return len(self._alerts)
+
+    def empty(self):
+        return len(self) == 0
+
+    def put(self, severity, color, message, alert_time):
+        # Returns False if the alert was dropped to keep the queue bounded
+        with self._lock:
+            self._expire()
+
+            key = (color, message)
+            alert = self._alerts.get(key)
+            if alert is not None:
+                alert.repeats += 1
+                alert.last_time = alert_time
+                alert.expiry = alert_time + self._timeout
+                return True
+
+            if len(self._alerts) >= self._max_size:
+                victim = max(self._alerts.values(), key=lambda a: (a.severity, a.alert_time))
+                if (victim.severity, victim.alert_time) <= (severity, alert_time):
+                    return False
+                del self._alerts[(victim.color, victim.message)]
+
+            alert = _QueuedAlert(severity, color, message, alert_time, alert_time + self._timeout, next(self._seq))
+            self._alerts[key] = alert
+            heapq.heappush(self._priority, (severity, alert_time, alert.seq, key))
+            heapq.heappush(self._expiry, (alert.expiry, alert.seq, key))
+
+            self._compact()
+            return True
+
+    def get(self):
+        # Returns (color, message, alert_time, last_time, repeats), or None if
+        # there's nothing to show
+        with self._lock:
+            self._expire()
+
+            while len(self._priority) > 0:
+                severity, alert_time, seq, key = heapq.heappop(self._priority)
+                alert = self._alerts.get(key)
+                if alert is not None and alert.seq == seq:
+                    del self._alerts[key]
+                    return alert.color, alert.message, alert.alert_time, alert.last_time, alert.repeats
+
+            return None
+
+    def _is_current(self, key, seq):
+        alert = self._alerts.get(key)
+        return alert is not None and alert.seq == seq
+
+    def _expire(self):
+        now = datetime.now()
+        while len(self._expiry) > 0 and self._expiry[0][0] <= now:
+            expiry, seq, key = heapq.heappop(self._expiry)
+            if self._is_current(key, seq):
+                alert = self._alerts[key]
+                if alert.expiry > now:
+                    # Repeated since this was scheduled, so check again later
+                    heapq.heappush(self._expiry, (alert.expiry, seq, key))
+                else:
+                    del self._alerts[key]
+
+    def _compact(self):
+        # Drop heap entries for alerts that have already gone
+        if len(self._priority) > 2 * len(self._alerts) + 16:
+            self._priority = [item for item in self._priority if self._is_current(item[3], item[2])]
+            heapq.heapify(self._priority)
+            self._expiry = [item for item in self._expiry if self._is_current(item[2], item[1])]
+            heapq.heapify(self._expiry)
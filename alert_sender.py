@@ -1,6 +1,6 @@
-from alerts import Alerts
+import alert_client
+from alert_client import AlertClient
 import argparse
-import socket
 
 
 parser = argparse.ArgumentParser(
@@ -17,14 +17,11 @@ args = parser.parse_args()
 server_color = None
 
 if args.color == 'r':
-    server_color = Alerts.RED
+    server_color = alert_client.RED
 elif args.color == 'g':
-    server_color = Alerts.GREEN
+    server_color = alert_client.GREEN
 else:
-    server_color = Alerts.YELLOW
+    server_color = alert_client.YELLOW
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.connect((args.host, int(args.port)))
-    msg = f'{server_color} {args.message}'
-    s.sendall(str.encode(msg))
-    print(s.recv(1024).decode())
+with AlertClient(args.host, args.port) as client:
+    print(client.send(server_color, args.message))
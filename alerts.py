@@ -1,112 +1,184 @@
-from Adafruit_LED_Backpack import BicolorMatrix8x8
-import board
+import hardware
+import alert_client
+from alert_queue import AlertQueue
+import asyncio
+from button import create_button
+from compositor import Compositor
 from datetime import datetime
-import digitalio
-import queue
-import socket
-from threading import Thread
-import time
+import metrics
+from threading import Event, RLock, Thread, Timer
 
 
 class Alerts():
-    RED = 'RED'
-    YELLOW = 'YEL'
-    GREEN = 'GRN'
+    RED = alert_client.RED
+    YELLOW = alert_client.YELLOW
+    GREEN = alert_client.GREEN
 
     ALERT_TIMEOUT = 43200
+    BUTTON_PIN = 16
+    BUTTON_DEBOUNCE = 0.3
+    CONNECTION_TIMEOUT = 10
+    MAX_MESSAGE_LENGTH = 4096
+    MAX_QUEUED = 1000
+
+    # Lower values are shown first
+    SEVERITY = {alert_client.RED: 0, alert_client.YELLOW: 1, alert_client.GREEN: 2}
     
     def __init__(self, config, matrix, text):
         self._matrix = matrix
         self._text = text
-        self._queue = queue.Queue()
+        self._queue = AlertQueue(self.MAX_QUEUED, self.ALERT_TIMEOUT)
+        self._display_lock = RLock()
+        self._alert_timer = None
+        self._display_wake = Event()
         self.showing_alert = False
         self.current_alert_time = None
         self._rtm = None
 
         # Initialise push button
-        self._button = digitalio.DigitalInOut(board.D16)
-        self._button.direction = digitalio.Direction.INPUT
-        self._button.pull = digitalio.Pull.DOWN
+        self._button = create_button(self.BUTTON_PIN, self._button_push, self.BUTTON_DEBOUNCE,
+                                     config.get('simulate_button', False))
 
-        Thread(target=self._start_server, args=(config['port'], )).start()
-        Thread(target=self._button_monitor).start()
+        metrics.gauge('alert_queue_depth', 'Alerts waiting to be shown', lambda: len(self._queue))
+
+        Thread(target=self._start_server, args=(config['port'], ), name='alert_server').start()
+        Thread(target=self._display_worker, name='alert_display').start()
 
     def register_rtm(self, rtm):
         self._rtm = rtm
     
     def _button_push(self):
-        if self.showing_alert:
-            self._matrix.stop_animation()
-            self._text.dots(4)
-            self.showing_alert = False
-            self.current_alert_time = None
-            if not self._queue.empty():
-                self._show_next_alert()
-            else:
-                if self._rtm is not None:
-                    self._rtm.display_tasks()
-
-
-    def _button_monitor(self):
-        while True:
-            if self._button.value:
-                self._button_push()
-            elif self.current_alert_time is not None and (datetime.now() - self.current_alert_time).total_seconds() > self.ALERT_TIMEOUT:
-                self._button_push()
-
-            time.sleep(0.1)
-
+        with self._display_lock:
+            if self.showing_alert:
+                self._dismiss_alert()
+            elif self._rtm is not None:
+                self._rtm.refresh()
+
+    def _alert_expired(self, alert_time):
+        with self._display_lock:
+            # Only dismiss the alert this timer was started for
+            if self.showing_alert and self.current_alert_time == alert_time:
+                self._dismiss_alert()
+
+    def _dismiss_alert(self):
+        if self._alert_timer is not None:
+            self._alert_timer.cancel()
+            self._alert_timer = None
+
+        # Releasing the alert layer uncovers the tasks and counters underneath
+        self._matrix.stop_animation(Compositor.ALERT)
+        self._text.clear(Compositor.ALERT)
+        self.showing_alert = False
+        self.current_alert_time = None
+        self._show_next_alert()
 
     def _start_server(self, port):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-            server_socket.bind(('0.0.0.0', port))
-            server_socket.listen()
-
-            print('Server started')
-            while True:
-                conn, addr = server_socket.accept()
-                with conn:
-                    data = conn.recv(1024).decode('utf-8')
-
-                    color, message = data.split(' ', 1)
-                    message = message.strip()
-
-                    response = 'OK'
+        asyncio.run(self._serve(port))
+
+    async def _serve(self, port):
+        server = await asyncio.start_server(self._handle_connection, '0.0.0.0', port, limit=self.MAX_MESSAGE_LENGTH)
+
+        print('Server started')
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        # Clients can send any number of alerts on one connection. Each gets
+        # its own acknowledgement line, in order, as soon as it is queued.
+        try:
+            open_connection = True
+            while open_connection:
+                try:
+                    data = await asyncio.wait_for(self._read_message(reader), self.CONNECTION_TIMEOUT)
+                    if len(data) == 0:
+                        break
+
+                    response = await self._submit(data)
+                except UnicodeDecodeError:
+                    response = 'Invalid encoding'
+                except (asyncio.LimitOverrunError, ValueError):
+                    # We can't find the start of the next message after this
+                    response = 'Message too long'
+                    open_connection = False
+
+                writer.write(f'{response}\n'.encode('utf-8'))
+                await asyncio.wait_for(writer.drain(), self.CONNECTION_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_message(reader):
+        # Messages end with a newline, or with the client closing its side
+        try:
+            data = await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            data = e.partial
+
+        return data.decode('utf-8')
+
+    async def _submit(self, data):
+        fields = data.strip().split(' ', 1)
+        color = fields[0]
+        message = fields[1].strip() if len(fields) > 1 else ''
+
+        return self.add_alert(color, message)
+
+    def add_alerts(self, alerts):
+        # For alerts raised inside this process. Takes and returns the same
+        # as AlertClient.send_many, without going through the server.
+        return [self.add_alert(color, message) for color, message in alerts]
+
+    def add_alert(self, color, message):
+        response = 'OK'
+
+        if color not in [self.RED, self.YELLOW, self.GREEN]:
+            response = f'Invalid color {color}'
+        elif len(message) == 0:
+            response = f'Empty message'
+        else:
+            if self._queue.put(self.SEVERITY[color], self._get_matrix_color(color), message, datetime.now()):
+                self._display_wake.set()
+            else:
+                response = 'Queue full'
 
-                    if color not in [self.RED, self.YELLOW, self.GREEN]:
-                        response = f'Invalid color {color}'
-                    elif len(message) == 0:
-                        response = f'Empty message'
-                    else:
-                        self._queue.put([self._get_matrix_color(color), message, datetime.now()])
-                        self._show_next_alert()
+        return response
 
-                    conn.sendall(response.encode('utf-8'))
+    def _display_worker(self):
+        while True:
+            self._display_wake.wait()
+            self._display_wake.clear()
+            self._show_next_alert()
 
     def _show_next_alert(self):
-        if not self.showing_alert:
-            done = False
-
-            while not done:
-                if self._queue.empty():
-                    done = True
-                else:
-                    color, message, alert_time = self._queue.get()
-                    if (datetime.now() - alert_time).total_seconds() < self.ALERT_TIMEOUT:
-                        self._matrix.start_animation(color)
-                        self._text.write(message)
-
-                        self.showing_alert = True
-                        self.current_alert_time = alert_time
-                        done = True
-
+        with self._display_lock:
+            if not self.showing_alert:
+                alert = self._queue.get()
+                if alert is not None:
+                    color, message, alert_time, last_time, repeats = alert
+                    metrics.observe('alert_display_delay_seconds', (datetime.now() - alert_time).total_seconds())
+                    if repeats > 1:
+                        message = f'{message} x{repeats}'
+
+                    self._matrix.start_animation(color, layer=Compositor.ALERT)
+                    self._text.write(message, Compositor.ALERT)
+
+                    self.showing_alert = True
+                    self.current_alert_time = alert_time
+
+                    # Repeats keep the alert up for the full timeout after the latest one
+                    remaining = self.ALERT_TIMEOUT - (datetime.now() - last_time).total_seconds()
+                    self._alert_timer = Timer(max(0, remaining), self._alert_expired, args=(alert_time, ))
+                    self._alert_timer.daemon = True
+                    self._alert_timer.start()
 
     def _get_matrix_color(self, color):
         if color == self.RED:
-            return BicolorMatrix8x8.RED
+            return hardware.RED
         elif color == self.GREEN:
-            return BicolorMatrix8x8.GREEN
+            return hardware.GREEN
         elif color == self.YELLOW:
-            return BicolorMatrix8x8.YELLOW
+            return hardware.YELLOW
         else:
             raise ValueError('Invalid color')
@@ -1,7 +1,45 @@
-from threading import Thread, Event
+import glob
+import json
+import logging
+import os
 import time
 import toml
-from Adafruit_LED_Backpack import BicolorMatrix8x8
+import hardware
+from compositor import Compositor
+
+
+class Frame():
+    # An 8x8 bicolor image held as two bitplanes, one byte per row.
+    # Pixel coordinates match BicolorMatrix8x8.set_pixel(x, y, color)
+    def __init__(self, green=None, red=None):
+        self.green = bytearray(8) if green is None else bytearray(green)
+        self.red = bytearray(8) if red is None else bytearray(red)
+
+    def set_pixel(self, x, y, color):
+        mask = 1 << x
+        if color & hardware.GREEN:
+            self.green[y] |= mask
+        else:
+            self.green[y] &= ~mask & 0xFF
+
+        if color & hardware.RED:
+            self.red[y] |= mask
+        else:
+            self.red[y] &= ~mask & 0xFF
+
+    def clear(self):
+        self.green[:] = bytes(8)
+        self.red[:] = bytes(8)
+
+    def copy(self):
+        return Frame(self.green, self.red)
+
+    def to_buffer(self):
+        # HT16K33 display RAM interleaves the green and red bytes for each row
+        buffer = bytearray(16)
+        buffer[0::2] = self.green
+        buffer[1::2] = self.red
+        return buffer
 
 
 class bcmatrix():
@@ -23,71 +61,94 @@ class bcmatrix():
     ]
     
     DELAY = 0.07
+    DEFAULT_ANIMATION = 'default'
+    BLANK_FRAME = bytes(16)
 
-    def __init__(self, config):
-        self._matrix = BicolorMatrix8x8.BicolorMatrix8x8(address=config['address'], busnum=config['i2c_bus'])
-        self._matrix.begin()
+    def __init__(self, config, compositor=None):
+        self._matrix = hardware.create_matrix(config)
         self._matrix.set_brightness(config['brightness'])
 
-        self.event = None
+        self._last_buffer = None
+        self._frame = Frame()
 
-    def _animation_running(self):
-        return self.event is not None
+        # Animations are stored as bitmask frames plus a frame rate, and
+        # compiled to raw display buffers once per colour when first used
+        self._animations = {self.DEFAULT_ANIMATION: (self.ANIMATION_FRAMES, 1 / self.DELAY)}
+        if 'animation_dir' in config:
+            self._load_animations(config['animation_dir'])
+        self._compiled_animations = dict()
 
-    def start_animation(self, color):
-        if self.event is not None:
-            raise ValueError('Animation is already active')
+        # All writes to the matrix happen on the compositor's render thread
+        self._compositor = compositor if compositor is not None else Compositor()
+        self._compositor.add_device(self)
 
-        self.color = color
-        self.event = Event()
-        Thread(target=self._run_animation, args=(self.event,)).start()
+    def _load_animations(self, animation_dir):
+        for file in sorted(glob.glob(os.path.join(animation_dir, '*.json'))):
+            try:
+                with open(file) as f:
+                    animation = json.load(f)
 
-    def stop_animation(self):
-        if self.event is not None:
-            self.event.set()
-            time.sleep(self.DELAY + 0.1)
+                name = os.path.splitext(os.path.basename(file))[0]
+                self._animations[name] = (animation['frames'], animation.get('fps', 1 / self.DELAY))
+            except Exception:
+                logging.error(f'Failed to load animation {file}')
 
-    def _run_animation(self, event):
-        frame_number = 0
+    def _compile_animation(self, name, color):
+        key = (name, color)
+        if key not in self._compiled_animations:
+            frames, fps = self._animations[name]
 
-        while not self.event.is_set():
-            self._matrix.clear()
+            buffers = list()
+            for rows in frames:
+                frame = Frame()
+                for row in range(len(rows)):
+                    row_mask = rows[row]
+                    for col in range(8):
+                        if 1 << col & row_mask:
+                            frame.set_pixel(row, col, color)
 
-            frame = self.ANIMATION_FRAMES[frame_number]
-            for row in range(len(frame)):
-                row_mask = frame[row]
-                for col in range(8):
-                    if 1 << col & row_mask:
-                        self._matrix.set_pixel(row, col, self.color)
+                buffers.append(bytes(frame.to_buffer()))
 
-            self._matrix.write_display()
-            frame_number += 1
-            if frame_number >= len(self.ANIMATION_FRAMES):
-                frame_number = 0
+            self._compiled_animations[key] = (buffers, fps)
 
-            time.sleep(self.DELAY)
+        return self._compiled_animations[key]
 
-        self.event = None
-        self._matrix.clear()
-        self._matrix.write_display()
+    def start_animation(self, color, name=DEFAULT_ANIMATION, layer=Compositor.ALERT):
+        buffers, fps = self._compile_animation(name, color)
+        self._compositor.submit(self, layer, buffers, 1 / fps)
 
-    def clear(self):
-        if not self._animation_running():
-            self._matrix.clear()
+    def stop_animation(self, layer=Compositor.ALERT):
+        self._compositor.release(self, layer)
+
+    def render(self, frame, layer=Compositor.TASKS):
+        self._compositor.submit(self, layer, [bytes(frame.to_buffer())])
+
+    def animate(self, frames, period, layer=Compositor.TASKS):
+        self._compositor.submit(self, layer, [bytes(frame.to_buffer()) for frame in frames], period)
+
+    def push(self, buffer):
+        # Called from the compositor's render thread only
+        if self._last_buffer is None:
+            first, last = 0, len(buffer) - 1
         else:
-            raise ValueError('Animation is active')
+            dirty = [i for i in range(len(buffer)) if buffer[i] != self._last_buffer[i]]
+            if len(dirty) == 0:
+                return
+            first, last = dirty[0], dirty[-1]
+
+        # Send the changed span of display RAM as one block write
+        # instead of the 16 single byte writes in write_display()
+        self._matrix.write_block(first, buffer[first:last + 1])
+        self._last_buffer = buffer
+
+    def clear(self):
+        self._frame.clear()
 
     def set_pixel(self, row, col, color):
-        if not self._animation_running():
-            self._matrix.set_pixel(row, col, color)
-        else:
-            raise ValueError('Animation is active')
+        self._frame.set_pixel(row, col, color)
 
     def write_display(self):
-        if not self._animation_running():
-            self._matrix.write_display()
-        else:
-            raise ValueError('Animation is active')
+        self.render(self._frame)
 
 if __name__ == "__main__":
     with open('config.toml') as config_file:
@@ -96,14 +157,15 @@ if __name__ == "__main__":
     bcm = bcmatrix(config['matrix'])
 
     while True:    
-        bcm.start_animation(BicolorMatrix8x8.RED)
+        bcm.start_animation(hardware.RED)
         time.sleep(2.5)
         bcm.stop_animation()
 
-        bcm.start_animation(BicolorMatrix8x8.YELLOW)
+        bcm.start_animation(hardware.YELLOW)
         time.sleep(2.5)
         bcm.stop_animation()
 
-        bcm.start_animation(BicolorMatrix8x8.GREEN)
+        bcm.start_animation(hardware.GREEN)
         time.sleep(2.5)
         bcm.stop_animation()
+        print(bcm._compositor.stats())
@@ -0,0 +1,278 @@
+import alert_client
+from alert_client import AlertClient
+import alerts
+import argparse
+import bcmatrix
+import compositor
+import counters
+from datetime import datetime, timedelta, timezone
+import hardware
+import json
+import metrics
+import os
+import random
+import rtm
+import socket
+import state_publisher
+import statistics
+import tempfile
+import text_display
+from threading import Event, Thread
+import time
+
+# Runs the whole program against the simulated displays and button, feeding
+# it recorded or synthetic RTM responses, counter sources and alert bursts,
+# and reports what it cost. Run it before and after a change to compare.
+
+parser = argparse.ArgumentParser(
+                    prog='RTM Matrix Benchmark',
+                    description='Benchmark the RTM Matrix program on simulated hardware')
+
+parser.add_argument('--rtm-responses', help='JSON file holding a list of recorded rtm.tasks.getList responses')
+parser.add_argument('--tasks', type=int, default=500, help='Tasks in the synthetic RTM response')
+parser.add_argument('--refreshes', type=int, default=50, help='RTM refreshes to time')
+parser.add_argument('--counters', type=int, default=8, help='Counter sources to run')
+parser.add_argument('--duration', type=float, default=10, help='Seconds to run the counters for')
+parser.add_argument('--alerts', type=int, default=20, help='Alerts in the burst')
+parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+parser.add_argument('--metrics', action='store_true', help='Also print the instrumentation metrics')
+
+args = parser.parse_args()
+
+
+class ReplaySession():
+    # Stands in for requests.Session, answering each request with the next
+    # recorded response and starting again from the first when they run out
+    class Response():
+        def __init__(self, body):
+            self.status_code = 200
+            self._body = body
+
+        def json(self):
+            return json.loads(self._body)
+
+    def __init__(self, bodies):
+        self._bodies = [json.dumps(body) for body in bodies]
+        self._next = 0
+        self.requests = 0
+
+    def get(self, url, timeout=None):
+        body = self._bodies[self._next]
+        self._next = (self._next + 1) % len(self._bodies)
+        self.requests += 1
+        return ReplaySession.Response(body)
+
+    def close(self):
+        pass
+
+
+def synthetic_tasks(count):
+    # Tasks due from a week ago to a week ahead, spread over a few lists
+    now = datetime.now(timezone.utc)
+    task_lists = dict()
+    for i in range(count):
+        due = now + timedelta(hours=random.randint(-7 * 24, 7 * 24))
+        series = {'id': str(i), 'task': {'id': str(i), 'due': due.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                         'completed': '', 'deleted': ''}}
+        if i % 10 == 0:
+            series['rrule'] = {'every': '1', '$t': 'FREQ=WEEKLY;INTERVAL=1'}
+        task_lists.setdefault(str(i % 5), list()).append(series)
+
+    return {'rsp': {'stat': 'ok', 'tasks': {'rev': 'benchmark', 'list': [
+        {'id': list_id, 'taskseries': series} for list_id, series in task_lists.items()]}}}
+
+
+def writes_per_second(start, end):
+    transactions = hardware.log.since(start)
+    results = dict()
+    for address in [config['matrix']['address'], config['text']['address']]:
+        results[address] = len([t for t in transactions if t[1] == address and t[0] < end]) / (end - start)
+
+    return results
+
+
+def shown_at(start, message, timeout=5):
+    # Time the text display first showed the start of a message after start
+    data = hardware.SimulatedSegments.to_buffer(text.compile(message)[0])
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for transaction in hardware.log.since(start, config['text']['address']):
+            if transaction[3] == data:
+                return transaction[0]
+        time.sleep(0.001)
+
+    return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if len(values) > 0 else None
+
+
+# Everything the program writes goes in a scratch directory
+work_dir = tempfile.TemporaryDirectory()
+os.chdir(work_dir.name)
+
+config = {
+    'matrix': {'address': 116, 'i2c_bus': 1, 'brightness': 10, 'simulate': True},
+    'text': {'address': 112, 'i2c_bus': 1, 'brightness': 0.4, 'simulate': True},
+    'rtm': {'api_key': 'key', 'shared_secret': 'secret', 'token': 'token',
+            'poll_interval': 24 * 3600, 'requests_per_hour': 3600 * 1000000, 'cache_file': 'task_cache.bin'},
+    'counters': {'file': 'counters.json'},
+    'alerts': {'port': free_port(), 'simulate_button': True},
+}
+
+if args.rtm_responses is not None:
+    with open(args.rtm_responses) as responses_file:
+        responses = json.load(responses_file)
+else:
+    responses = [synthetic_tasks(args.tasks)]
+
+results = dict()
+
+compositor = compositor.Compositor()
+matrix = bcmatrix.bcmatrix(config['matrix'], compositor)
+text = text_display.text_display(config['text'], compositor)
+publisher = state_publisher.StatePublisher()
+
+# RTM: time each refresh on this thread, after the first one the RTM thread does itself
+session = ReplaySession(responses)
+rtm = rtm.RTM(matrix, config['rtm'], publisher, session)
+deadline = time.monotonic() + 10
+while session.requests == 0 or rtm._counts is None:
+    if time.monotonic() > deadline:
+        raise Exception('RTM never fetched its tasks')
+    time.sleep(0.01)
+
+cpu = list()
+wall = list()
+for i in range(args.refreshes):
+    start_cpu = time.thread_time()
+    start_wall = time.perf_counter()
+    rtm._fetch_tasks()
+    rtm.display_tasks()
+    cpu.append(time.thread_time() - start_cpu)
+    wall.append(time.perf_counter() - start_wall)
+
+results['rtm'] = {
+    'tasks': len(rtm._task_store),
+    'refreshes': args.refreshes,
+    'cpu_ms_per_refresh': statistics.mean(cpu) * 1000,
+    'wall_ms_per_refresh': statistics.mean(wall) * 1000,
+    'wall_ms_p95': percentile(wall, 0.95) * 1000,
+}
+
+# Counters: file sources that change every few seconds, with one second
+# delays. They're labelled with digits so they can't be mistaken for alerts.
+counter_files = list()
+counter_config = list()
+for i in range(args.counters):
+    counter_files.append(f'counter{i}.txt')
+    with open(counter_files[-1], 'w') as f:
+        f.write('1')
+    counter_config.append({'label': str(i % 10), 'method': 'number_file',
+                           'params': [counter_files[-1]], 'delay': 1})
+
+with open(config['counters']['file'], 'w') as f:
+    json.dump(counter_config, f)
+
+stop_writer = Event()
+
+
+def write_counters():
+    while not stop_writer.wait(random.uniform(0.5, 3)):
+        with open(random.choice(counter_files), 'w') as f:
+            f.write(str(random.randint(1, 999)))
+
+
+Thread(target=write_counters, daemon=True).start()
+counters = counters.Counters(text, config['counters'], publisher)
+
+start = time.monotonic()
+time.sleep(args.duration)
+end = time.monotonic()
+stop_writer.set()
+
+rates = writes_per_second(start, end)
+results['counters'] = {
+    'counters': args.counters,
+    'seconds': args.duration,
+    'matrix_writes_per_second': rates[config['matrix']['address']],
+    'text_writes_per_second': rates[config['text']['address']],
+}
+
+# Alerts: a burst on one connection, then step through them with the button.
+# Latency is from sending, or pressing, to the text display showing the
+# alert. Each alert starts with a different letter so its first frame differs.
+alerts = alerts.Alerts(config['alerts'], matrix, text)
+
+deadline = time.monotonic() + 10
+while True:
+    try:
+        start = time.monotonic()
+        client = AlertClient('127.0.0.1', config['alerts']['port'])
+        client.send(alert_client.GREEN, 'READY')
+        break
+    except OSError:
+        if time.monotonic() > deadline:
+            raise
+        client.close()
+        time.sleep(0.05)
+
+# The send returns once READY is queued, so wait until it's on the display
+# or the press would go to RTM instead of dismissing it
+if shown_at(start, 'READY') is None:
+    raise Exception('The READY alert was never shown')
+alerts._button.press()
+time.sleep(alerts.BUTTON_DEBOUNCE)
+
+colors = [alert_client.RED, alert_client.YELLOW, alert_client.GREEN]
+burst = [(colors[i % 3], f'{chr(ord("A") + i % 26)} benchmark alert {i}') for i in range(args.alerts)]
+
+start = time.monotonic()
+responses = client.send_many(burst)
+acknowledged = time.monotonic() - start
+# They come off the queue most severe first
+shown_order = sorted(burst, key=lambda alert: alerts.SEVERITY[alert[0]])
+shown = shown_at(start, shown_order[0][1])
+client.close()
+
+latency = [shown - start] if shown is not None else list()
+for i in range(args.alerts - 1):
+    time.sleep(alerts.BUTTON_DEBOUNCE)
+    start = time.monotonic()
+    alerts._button.press()
+    shown = shown_at(start, shown_order[i + 1][1])
+    if shown is not None:
+        latency.append(shown - start)
+
+results['alerts'] = {
+    'alerts': args.alerts,
+    'accepted': responses.count('OK'),
+    'burst_ack_ms': acknowledged * 1000,
+    'latency_ms_mean': statistics.mean(latency) * 1000 if len(latency) > 0 else None,
+    'latency_ms_p95': percentile(latency, 0.95) * 1000 if len(latency) > 0 else None,
+    'latency_ms_max': max(latency) * 1000 if len(latency) > 0 else None,
+}
+
+results['compositor'] = compositor.stats()
+
+if args.json:
+    print(json.dumps(results, indent=2))
+else:
+    for section, values in results.items():
+        print(section)
+        for name, value in values.items():
+            print(f'  {name}: {value:.3f}' if isinstance(value, float) else f'  {name}: {value}')
+
+if args.metrics:
+    print(metrics.registry.render())
+
+# The program's threads run forever, so don't wait for them
+os._exit(0)
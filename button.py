@@ -0,0 +1,69 @@
+import logging
+from threading import Lock
+import time
+
+try:
+    import RPi.GPIO as GPIO
+    _GPIO_ERROR = None
+except (ImportError, RuntimeError) as e:
+    # Not on a Pi, so only the simulated button is available
+    GPIO = None
+    _GPIO_ERROR = e
+
+
+class _Debouncer():
+    def __init__(self, callback, debounce):
+        self._callback = callback
+        self._debounce = debounce
+        self._last_press = None
+        self._lock = Lock()
+
+    def press(self, *args):
+        with self._lock:
+            now = time.monotonic()
+            if self._last_press is not None and now - self._last_press < self._debounce:
+                return
+            self._last_press = now
+
+        self._callback()
+
+
+class GpioButton():
+    # Calls back on the rising edge of a pulled-down input, rather than polling it
+
+    def __init__(self, pin, callback, debounce):
+        self._pin = pin
+        self._debouncer = _Debouncer(callback, debounce)
+
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+        GPIO.add_event_detect(pin, GPIO.RISING, callback=self._debouncer.press, bouncetime=int(debounce * 1000))
+
+    def close(self):
+        GPIO.remove_event_detect(self._pin)
+        GPIO.cleanup(self._pin)
+
+
+class SimulatedButton():
+    # Stands in for the hardware button; call press() to push it
+
+    def __init__(self, pin, callback, debounce):
+        self._pin = pin
+        self._debouncer = _Debouncer(callback, debounce)
+
+    def press(self):
+        self._debouncer.press()
+
+    def close(self):
+        pass
+
+
+def create_button(pin, callback, debounce=0.2, simulated=False):
+    if simulated:
+        return SimulatedButton(pin, callback, debounce)
+    elif GPIO is None:
+        # On a Pi this means the button won't work, so say why
+        logging.warning(f'RPi.GPIO unavailable ({_GPIO_ERROR}), so the button on pin {pin} is simulated')
+        return SimulatedButton(pin, callback, debounce)
+    else:
+        return GpioButton(pin, callback, debounce)
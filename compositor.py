@@ -0,0 +1,227 @@
+from bisect import bisect_right
+import itertools
+import math
+import metrics
+import queue
+from threading import Thread
+import time
+import traceback
+
+
+class _Sequence():
+    __slots__ = ('frames', 'ends', 'start', 'items', 'pushes', 'first_push', 'last_push', 'late_sum', 'late_squares')
+
+    def __init__(self, frames, period, start, items=None):
+        self.frames = frames
+        self.start = start
+        self.items = items
+
+        # Achieved frame timing, measured as frames are pushed
+        self.pushes = 0
+        self.first_push = None
+        self.last_push = None
+        self.late_sum = 0
+        self.late_squares = 0
+
+        # End time of each frame relative to the start, or None if static
+        if period is None or len(frames) == 1:
+            self.ends = None
+        else:
+            durations = period if isinstance(period, (list, tuple)) else itertools.repeat(period, len(frames))
+            self.ends = list(itertools.accumulate(durations))
+
+    def frame_at(self, now):
+        # Returns the frame index to show and the time until the next one
+        if self.ends is None:
+            return 0, None
+
+        offset = (now - self.start) % self.ends[-1]
+        index = bisect_right(self.ends, offset)
+        return index, self.ends[index] - offset
+
+    def frame_start(self, index):
+        return self.ends[index - 1] if index > 0 else 0
+
+    def resume_from(self, previous, now):
+        # Carry on from the item the previous sequence was showing, so a
+        # playlist that changes often doesn't keep going back to the start
+        if self.ends is None or previous.items is None:
+            return
+
+        index, remaining = previous.frame_at(now)
+        item = previous.items[index]
+        elapsed = 0 if remaining is None else previous.ends[index] - previous.frame_start(index) - remaining
+
+        if item in self.items:
+            first = self.items.index(item)
+            within = index - previous.items.index(item)
+            if within >= self.items.count(item):
+                within, elapsed = 0, 0
+            index = first + within
+        else:
+            # The item went away, so move on to the one after it
+            later = [i for i, other in enumerate(self.items) if other > item]
+            index, elapsed = (later[0] if len(later) > 0 else 0), 0
+
+        duration = self.ends[index] - self.frame_start(index)
+        self.start = now - self.frame_start(index) - min(elapsed, duration)
+
+    def record_push(self, now, late):
+        # late is how long after its scheduled time the frame went out. The
+        # first frame goes out when the sequence arrives, so isn't counted.
+        self.pushes += 1
+        self.last_push = now
+        if self.first_push is None:
+            self.first_push = now
+        else:
+            self.late_sum += late
+            self.late_squares += late * late
+
+    def timing(self):
+        # Achieved frames per second, and the jitter in when frames went out
+        if self.pushes < 2 or self.last_push == self.first_push:
+            return None
+
+        mean = self.late_sum / (self.pushes - 1)
+        return {
+            'fps': (self.pushes - 1) / (self.last_push - self.first_push),
+            'jitter': math.sqrt(max(0, self.late_squares / (self.pushes - 1) - mean * mean))
+        }
+
+
+class Compositor():
+    # Owns the displays and is the only thing that writes to them. Producers
+    # submit frame sequences to a layer on a device, and each device shows
+    # its highest priority layer. Requests arrive through a SimpleQueue so
+    # producers never block on the render thread.
+    ALERT = 0
+    COUNTER = 1
+    TASKS = 2
+
+    def __init__(self):
+        self._requests = queue.SimpleQueue()
+        self._devices = list()
+        self._layers = dict()
+        self._shown = dict()
+        self._stats = dict()
+        self._animations = dict()
+        self._thread = None
+
+        metrics.gauge('compositor_requests_queued', 'Requests waiting for the render thread', self._requests.qsize)
+        metrics.gauge('display_writes_total', 'Frames pushed to each display',
+                      lambda: [({'device': name}, stats['writes']) for name, stats in self.stats().items()], 'counter')
+        metrics.gauge('display_dropped_frames_total', 'Animation frames skipped because rendering ran late',
+                      lambda: [({'device': name}, stats['dropped']) for name, stats in self.stats().items()], 'counter')
+
+    def add_device(self, device):
+        # Devices must provide push(frame), which writes to the hardware
+        # only if the frame differs from the last one pushed, and BLANK_FRAME
+        # which is shown when no layer has anything
+        self._requests.put(('add', device, None, None))
+        self.start()
+
+    def submit(self, device, layer, frames, period=None, items=None):
+        # period is the time each frame is shown for, either a single value
+        # or one per frame. Sequences with more than one frame loop. items
+        # optionally names the playlist entry each frame belongs to, and a
+        # new playlist then resumes from the entry that was showing.
+        self._requests.put(('submit', device, layer, (list(frames), period, items)))
+
+    def release(self, device, layer):
+        self._requests.put(('release', device, layer, None))
+
+    def stats(self):
+        # Writes and dropped frames per device, plus the achieved frame rate
+        # and jitter of its latest animation
+        results = dict()
+        for device, stats in list(self._stats.items()):
+            results[device.__class__.__name__] = dict(stats)
+
+            sequence = self._animations.get(device)
+            timing = sequence.timing() if sequence is not None else None
+            if timing is not None:
+                results[device.__class__.__name__].update(timing)
+
+        return results
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._render_loop, name='compositor', daemon=True)
+            self._thread.start()
+
+    def _render_loop(self):
+        wait = None
+
+        while True:
+            try:
+                self._apply(self._requests.get(timeout=wait))
+                while True:
+                    self._apply(self._requests.get_nowait())
+            except queue.Empty:
+                pass
+
+            try:
+                wait = self._render(time.monotonic())
+            except Exception:
+                print(traceback.format_exc())
+                wait = None
+
+    def _apply(self, request):
+        action, device, layer, content = request
+
+        if action == 'add':
+            self._devices.append(device)
+            self._layers.setdefault(device, dict())
+            self._stats[device] = {'writes': 0, 'dropped': 0}
+        elif action == 'submit':
+            frames, period, items = content
+            now = time.monotonic()
+            sequence = _Sequence(frames, period, now, items)
+
+            layers = self._layers.setdefault(device, dict())
+            if items is not None and layer in layers:
+                sequence.resume_from(layers[layer], now)
+            layers[layer] = sequence
+        elif action == 'release':
+            self._layers.get(device, dict()).pop(layer, None)
+
+    def _render(self, now):
+        # Push the current frame of each device's top layer, at most one
+        # write per device, and return how long until something changes
+        wait = None
+
+        for device in self._devices:
+            layers = self._layers[device]
+            if len(layers) == 0:
+                if self._shown.get(device) is not None:
+                    with metrics.timer('display_push_seconds', device=device.__class__.__name__):
+                        device.push(device.BLANK_FRAME)
+                    self._stats[device]['writes'] += 1
+                    self._shown[device] = None
+                continue
+
+            layer = min(layers)
+            sequence = layers[layer]
+            index, remaining = sequence.frame_at(now)
+
+            shown_sequence, shown_index = self._shown.get(device) or (None, None)
+            if shown_sequence is not sequence or shown_index != index:
+                if shown_sequence is sequence:
+                    # Frames we were too late to show
+                    self._stats[device]['dropped'] += (index - shown_index - 1) % len(sequence.frames)
+
+                with metrics.timer('display_push_seconds', device=device.__class__.__name__):
+                    device.push(sequence.frames[index])
+                self._stats[device]['writes'] += 1
+
+                if sequence.ends is not None:
+                    pushed = time.monotonic()
+                    scheduled = now - (sequence.ends[index] - sequence.frame_start(index) - remaining)
+                    sequence.record_push(pushed, pushed - scheduled)
+                    self._animations[device] = sequence
+                self._shown[device] = (sequence, index)
+
+            if remaining is not None and (wait is None or remaining < wait):
+                wait = remaining
+
+        return wait
@@ -0,0 +1,76 @@
+import asyncio
+import os
+from threading import Thread
+import traceback
+
+
+class CounterListener():
+    # Receives counter values pushed by other programs, as lines of
+    # "name value". Any of a UDP port, a Unix socket and a TCP port can be
+    # configured. Stream connections can stay open and send any number of
+    # lines. Each value is passed to on_value(name, value) as it arrives.
+    MAX_LINE_LENGTH = 4096
+
+    def __init__(self, config, on_value):
+        self._config = config
+        self._on_value = on_value
+
+        Thread(target=self._start, name='counter_listener', daemon=True).start()
+
+    def _start(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        # Servers start accepting as soon as they're created
+        servers = list()
+
+        if self._config.get('tcp_port'):
+            servers.append(await asyncio.start_server(self._handle_stream, self._config.get('host', '127.0.0.1'),
+                                                      self._config['tcp_port'], limit=self.MAX_LINE_LENGTH))
+
+        if self._config.get('socket'):
+            if os.path.exists(self._config['socket']):
+                os.unlink(self._config['socket'])
+            servers.append(await asyncio.start_unix_server(self._handle_stream, self._config['socket'],
+                                                           limit=self.MAX_LINE_LENGTH))
+
+        if self._config.get('udp_port'):
+            await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _DatagramProtocol(self._receive), local_addr=(self._config.get('host', '127.0.0.1'),
+                                                                      self._config['udp_port']))
+
+        await asyncio.Event().wait()
+
+    async def _handle_stream(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    line = e.partial
+
+                if len(line) == 0:
+                    break
+                self._receive(line)
+        except (asyncio.LimitOverrunError, ValueError, ConnectionError):
+            # Can't find the end of an overlong line, so give up on the connection
+            pass
+        finally:
+            writer.close()
+
+    def _receive(self, data):
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                try:
+                    self._on_value(fields[0], fields[1].strip())
+                except Exception:
+                    print(traceback.format_exc())
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, receive):
+        self._receive = receive
+
+    def datagram_received(self, data, addr):
+        self._receive(data)
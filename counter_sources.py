@@ -0,0 +1,249 @@
+from abc import ABC, abstractmethod
+import os
+import shutil
+import socket
+from threading import Lock
+import traceback
+
+# Counter sources, by the method name used in counters.json. Counters
+# creates one source for each method it's configured with, so a source
+# should import the libraries it needs in __init__ rather than at the top
+# of this module. Other packages can add sources with an entry point in
+# the ENTRY_POINT_GROUP group that names a Source subclass.
+
+ENTRY_POINT_GROUP = 'rtm_matrix.counter_sources'
+
+
+def format_number(number):
+    text = None
+
+    if number is not None and int(number) > 0:
+        value = int(number)
+        if value >= 1000000:
+            text = f'***'
+        elif value >= 1000:
+            val = float(value) / 1000
+            if val > 10:
+                text = f'{val:.1f}'
+            else:
+                text = f'{val:.2f}'
+        else:
+            text = f'{value:3d}'
+
+    return text
+
+
+def lookup(document, key_path):
+    for key in key_path:
+        document = document[key]
+
+    return document
+
+
+class Source(ABC):
+    # Range of the number of params a counter can give the source
+    MIN_PARAMS = 1
+    MAX_PARAMS = 1
+
+    def __init__(self, counters, method):
+        self._counters = counters
+        self._method = method
+        self._timeout = counters.timeout(method)
+
+    @classmethod
+    def validate(cls, params):
+        # Check a counter's params when counters.json is loaded, and return
+        # them in the form get() takes
+        if not isinstance(params, list) or not cls.MIN_PARAMS <= len(params) <= cls.MAX_PARAMS:
+            raise ValueError(f'expected {cls.MIN_PARAMS} to {cls.MAX_PARAMS} params, got {params!r}')
+
+        return params
+
+    @abstractmethod
+    def get(self, *params):
+        # Returns the text to show, or None to hide the counter
+        pass
+
+
+class NumberFile(Source):
+    def get(self, file):
+        # Values published in this process can be read without touching the disk
+        publisher = self._counters.publisher
+        file_result = publisher.file_value(file) if publisher is not None else None
+
+        if file_result is None and os.path.exists(file):
+            with open(file) as f:
+                file_result = f.readline().strip()
+                if file_result == '':
+                    file_result = None
+
+        return format_number(file_result)
+
+
+class NumberUrl(Source):
+    def get(self, url):
+        result = None
+
+        try:
+            result = int(self._counters.get_url(url, timeout=self._timeout))
+        except:
+            print(traceback.format_exc())
+
+        return format_number(result)
+
+
+class NumberServer(Source):
+    MIN_PARAMS = 2
+    MAX_PARAMS = 2
+
+    def get(self, host, port):
+        result = None
+
+        try:
+            with socket.create_connection((host, port), timeout=self._timeout) as client_socket:
+                data = client_socket.recv(1024)
+                result = int(data)
+        except:
+            print(traceback.format_exc())
+
+        return format_number(result)
+
+
+class NumberJsonUrl(Source):
+    MIN_PARAMS = 2
+    MAX_PARAMS = 4
+
+    def __init__(self, counters, method):
+        super().__init__(counters, method)
+        import requests
+        self._connection_error = requests.exceptions.ConnectionError
+
+    @classmethod
+    def validate(cls, params):
+        # Split the key path once rather than on every refresh
+        params = super().validate(params)
+        return [params[0], tuple(params[1].split('/'))] + params[2:]
+
+    def get(self, url, key, headers=None, transient=False):
+        result = None
+
+        try:
+            response = self._counters.get_json_url(url, headers, self._timeout)
+            result = lookup(response, key)
+        except self._connection_error as e:
+            if transient:
+                # We expect that the server won't always be around
+                pass
+            else:
+                print(traceback.format_exc())
+        except Exception as e:
+            print(traceback.format_exc())
+
+        return format_number(result)
+
+
+class TextJsonUrl(Source):
+    MIN_PARAMS = 2
+    MAX_PARAMS = 2
+
+    @classmethod
+    def validate(cls, params):
+        params = super().validate(params)
+        return [params[0], (params[1], )]
+
+    def get(self, url, key):
+        response = self._counters.get_json_url(url, timeout=self._timeout)
+        return lookup(response, key)
+
+
+class DirCount(Source):
+    def __init__(self, counters, method):
+        super().__init__(counters, method)
+        from dir_counter import DirCounter
+        self._dir_counter = DirCounter
+        self._dir_counters = dict()
+        self._lock = Lock()
+
+    def get(self, path):
+        result = None
+
+        try:
+            # Each path's DirCounter is shared by every counter using it
+            with self._lock:
+                if path not in self._dir_counters:
+                    self._dir_counters[path] = self._dir_counter(path)
+                dir_counter = self._dir_counters[path]
+
+            result = dir_counter.count()
+        except:
+            print(traceback.format_exc())
+
+        return format_number(result)
+
+
+class FreeSpace(Source):
+    def get(self, path):
+        result = None
+
+        try:
+            total, used, free = shutil.disk_usage(path)
+            result = free / (1024 ** 2)
+            if result > 1000:
+                result = result / 1000
+        except:
+            print(traceback.format_exc())
+
+        return format_number(int(result))
+
+
+class UnreadEmail(Source):
+    MIN_PARAMS = 3
+    MAX_PARAMS = 3
+
+    def __init__(self, counters, method):
+        super().__init__(counters, method)
+        from imap_account import ImapAccount
+        self._imap_account = ImapAccount
+        self._accounts = dict()
+
+    def get(self, server, email, password):
+        account_key = (server, email)
+        if account_key not in self._accounts:
+            self._accounts[account_key] = self._imap_account(server, email, password, self._timeout,
+                lambda count: self._counters.push(self._method, account_key, format_number(count)))
+
+        return format_number(self._accounts[account_key].unread())
+
+
+class Pushed(Source):
+    # A counter that is only ever pushed to. Its name is its only param.
+    def get(self, name):
+        return self._counters.pushed_value(name)
+
+
+SOURCES = {
+    'number_file': NumberFile,
+    'number_url': NumberUrl,
+    'number_server': NumberServer,
+    'number_json_url_source': NumberJsonUrl,
+    'text_json_url_source': TextJsonUrl,
+    'dir_count': DirCount,
+    'free_space': FreeSpace,
+    'unread_email': UnreadEmail,
+    'pushed': Pushed,
+}
+
+
+def find(method):
+    # The source class for a method, looking in installed packages only
+    # for methods that aren't built in
+    if method in SOURCES:
+        return SOURCES[method]
+
+    from importlib.metadata import entry_points
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP, name=method):
+        source = entry_point.load()
+        SOURCES[method] = source
+        return source
+
+    raise ValueError(f'Unknown counter method {method}')
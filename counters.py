@@ -1,219 +1,207 @@
+from concurrent.futures import ThreadPoolExecutor
+import counter_sources
 from datetime import datetime
-import glob
-import imaplib
+import heapq
 import json
-import os
-import requests
-import shutil
-import socket
-from threading import Thread
+import metrics
+from threading import Condition, Lock, Thread
 import time
 import traceback
 
 class Counters():
     DELAY = 3
+    RETRY_DELAY = 30
+    DEFAULT_TIMEOUT = 10
+    DEFAULT_CONCURRENCY = 2
 
-    def __init__(self, display, config):
+    def __init__(self, display, config, publisher=None):
         self._display = display
+        self.publisher = publisher
         self._config = config
-        self._url_cache = dict()
+
+        # Created when a URL source first needs it
+        self._url_cache = None
+        self._url_cache_lock = Lock()
+
+        # Each source type gets its own small pool so a hung source can only
+        # tie up its own workers
+        self._executors = dict()
 
         self._alerts = None
 
         with open(config['file']) as cin:
             self._counters = json.loads(cin.read())
 
+        # Check every counter before starting any, then create one source
+        # for each method in use. Sources import their own dependencies, so
+        # only the ones configured are loaded.
+        source_classes = dict()
+        for i, c in enumerate(self._counters):
+            try:
+                for key in ['label', 'method', 'params', 'delay']:
+                    if key not in c:
+                        raise ValueError(f'missing {key}')
+                if not isinstance(c['delay'], (int, float)) or c['delay'] <= 0:
+                    raise ValueError('delay must be a positive number of seconds')
+
+                if c['method'] not in source_classes:
+                    source_classes[c['method']] = counter_sources.find(c['method'])
+                c['params'] = source_classes[c['method']].validate(c['params'])
+            except Exception as e:
+                raise ValueError(f'Counter {i} in {config["file"]}: {e}') from e
+
+        self._sources = {method: source_class(self, method) for method, source_class in source_classes.items()}
+
+        # Counters can also be pushed to by name, through the listener, while
+        # still polling their source as a fallback
+        self._push_names = dict()
+        for i, c in enumerate(self._counters):
+            name = c['params'][0] if c['method'] == 'pushed' else c.get('push')
+            if name is not None:
+                self._push_names.setdefault(name, list()).append(i)
+        self._pushed_values = dict()
+
+        if len(self._push_names) > 0 and not config.get('listen'):
+            raise ValueError(f'Counters in {config["file"]} take pushed values but [counters.listen] is not configured')
+
+        # Heap of (next due time, counter index), and the number of counters
+        # of each method waiting for or running on their executor
+        self._schedule = list()
+        self._pending = dict()
+        self._schedule_condition = Condition()
+        self._display_lock = Lock()
+
+        # Each URL is refreshed at the shortest delay of the counters using it
+        self._url_delays = dict()
         for c in self._counters:
+            if len(c['params']) > 0 and isinstance(c['params'][0], str):
+                url = c['params'][0]
+                self._url_delays[url] = min(c['delay'], self._url_delays.get(url, c['delay']))
+
+        for i, c in enumerate(self._counters):
             c['text'] = None
             c['last_get'] = None
+            c['pushed_at'] = None
+            heapq.heappush(self._schedule, (time.monotonic(), i))
 
-        Thread(target=self._display_counters).start()
-        Thread(target=self._retrieve_counters).start()
+        metrics.gauge('counters_pending', 'Counters waiting for or being retrieved by each source',
+                      lambda: [({'method': method}, count) for method, count in self._pending.items()])
+        metrics.gauge('url_cache_requests_total', 'URL cache lookups by result',
+                      lambda: [({'result': result}, count) for result, count in self._url_cache_stats().items()
+                               if result != 'entries'], 'counter')
+        metrics.gauge('url_cache_entries', 'URLs held in the cache', lambda: self._url_cache_stats().get('entries', 0))
+
+        if len(self._push_names) > 0:
+            from counter_listener import CounterListener
+            self._listener = CounterListener(config['listen'], self._receive)
+
+        Thread(target=self._retrieve_counters, name='counters').start()
         
     def register_alerts(self, alerts):
         self._alerts = alerts
 
-    def _display_counters(self):
-        while True:
-            for c in self._counters:
-                if c['text'] is not None:
-                    if self._alerts is None or not self._alerts.showing_alert:
-                        self._display.write(c['label'] + str(c['text']))
-                    time.sleep(self.DELAY)
-        
-
     def _retrieve_counters(self):
         while True:
-            for c in self._counters:
-                if c['last_get'] is None or (datetime.now() - c['last_get']).total_seconds() > c['delay']:
-                    try:
-                        c['text'] = getattr(self, '_' + c['method'])(*c['params'])
-                        c['last_get'] = datetime.now()
-                    except Exception as e:
-                        print(traceback.format_exc())
-
-            time.sleep(1)
-
-    def _get_url(self, url, headers=None):
-        if url not in self._url_cache.keys():
-            # Find the URL's minimum delay
-            min_delay = 999999999
-            for counter in self._counters:
-                if counter['params'][0] == url and counter['delay'] < min_delay:
-                    min_delay = counter['delay']
-
-            self._url_cache[url] = {
-                "delay": min_delay,
-                "last_get": None,
-                "response": None
-            }
-
-        cache_entry = self._url_cache[url]
-        if cache_entry['last_get'] is None \
-            or (datetime.now() - cache_entry['last_get']).total_seconds() > cache_entry['delay']:
-            
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            cache_entry['response'] = response.text
-            cache_entry['last_get'] = datetime.now()
-
-        return cache_entry['response']
-
-
-    @staticmethod
-    def _format_number(number):
-        text = None
-
-        if number is not None and int(number) > 0:
-            value = int(number)
-            if value >= 1000000:
-                text = f'***'
-            elif value >= 1000:
-                val = float(value) / 1000
-                if val > 10:
-                    text = f'{val:.1f}'
-                else:
-                    text = f'{val:.2f}'
-            else:
-                text = f'{value:3d}'
-
-        return text
-
-    @staticmethod
-    def _number_file(file):
-        file_result = None
-
-        if os.path.exists(file):
-            with open(file) as f:
-                file_result = f.readline().strip()
-                if file_result == '':
-                    file_result = None
-
-        return Counters._format_number(file_result)
-
-    def _number_url(self, url):
-        result = None
-
-        try:
-            result = int(self._get_url(url))
-        except:
-            print(traceback.format_exc())
-
-
-        return Counters._format_number(result)
-
-    @staticmethod
-    def _number_server(host, port):
-        result = None
-        
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-                client_socket.connect((host, port))
-                data = client_socket.recv(1024)
-                result = int(data)
-        except:
-            print(traceback.format_exc())
-
-        return Counters._format_number(result)
-
-
-    def _number_json_url_source(self, url, key, headers=None, transient=False):
-        result = None
-
-        try:
-            response = json.loads(self._get_url(url, headers))
-            
-            key_elements = key.split('/')
-            for key in key_elements:
-                response = response[key]
-
-            result = response
-        except requests.exceptions.ConnectionError as e:
-            if transient:
-                # We expect that the server won't always be around
-                pass
-            else:
+            with self._schedule_condition:
+                while True:
+                    if len(self._schedule) == 0:
+                        self._schedule_condition.wait()
+                    else:
+                        wait = self._schedule[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._schedule_condition.wait(wait)
+
+                due, index = heapq.heappop(self._schedule)
+                method = self._counters[index]['method']
+                self._pending[method] = self._pending.get(method, 0) + 1
+
+            metrics.observe('counter_schedule_lag_seconds', time.monotonic() - due)
+            self._executor(method).submit(self._retrieve, index)
+
+    def _retrieve(self, index):
+        c = self._counters[index]
+        next_delay = min(c['delay'], self.RETRY_DELAY)
+
+        pushed_age = None if c['pushed_at'] is None else time.monotonic() - c['pushed_at']
+        if pushed_age is not None and pushed_age < c['delay']:
+            # Counters that are pushed to are only polled once the pushes stop
+            next_delay = c['delay'] - pushed_age
+        else:
+            try:
+                with metrics.timer('counter_source_seconds', method=c['method']):
+                    text = self._sources[c['method']].get(*c['params'])
+                self._set_text(c, text)
+                c['last_get'] = datetime.now()
+                next_delay = c['delay']
+            except Exception as e:
                 print(traceback.format_exc())
-        except Exception as e:
-            print(traceback.format_exc())
-    
-        return Counters._format_number(result)
-
-    def _text_json_url_source(self, url, key):
-        result = None
-
-        response = json.loads(self._get_url(url))
-        result = response[key]
-    
-        return result
-
-    @staticmethod
-    def _dir_count(path):
-        result = None
-
-        try:
-            result = len(glob.glob(os.path.join(path, '**'), recursive=True)) - 1
-        except:
-            print(traceback.format_exc())
-
-        return Counters._format_number(result)
-        
-    @staticmethod
-    def _free_space(path):
-        result = None
-
-        try:
-            total, used, free = shutil.disk_usage(path)
-            result = free / (1024 ** 2)
-            if result > 1000:
-                result = result / 1000
-        except:
-            print(traceback.format_exc())
-
-        return Counters._format_number(int(result))
-
-    @staticmethod
-    def _unread_email(server, email, password):
-        # Connect to the IMAP server
-        mail = imaplib.IMAP4_SSL(server)
-        
-        # Log in to your account
-        mail.login(email, password)
-
-        # Select the mailbox you want to check (default is 'Inbox')
-        mail.select('inbox')
-
-        # Search for unread emails
-        result, data = mail.search(None, 'UNSEEN')
-
-        # Get the list of email IDs
-        email_ids = data[0].split()
-        
-        # Count of unread emails
-        unread_count = len(email_ids)
-
-        # Logout from the server
-        mail.logout()
-
-        return Counters._format_number(int(unread_count))
 
+        with self._schedule_condition:
+            self._pending[c['method']] -= 1
+            heapq.heappush(self._schedule, (time.monotonic() + next_delay, index))
+            self._schedule_condition.notify()
+
+    def _source_config(self, method):
+        return self._config.get('sources', dict()).get(method, dict())
+
+    def timeout(self, method):
+        return self._source_config(method).get('timeout', self._config.get('default_timeout', self.DEFAULT_TIMEOUT))
+
+    def _executor(self, method):
+        if method not in self._executors:
+            workers = self._source_config(method).get('concurrency', self.DEFAULT_CONCURRENCY)
+            self._executors[method] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=method)
+
+        return self._executors[method]
+
+    def _set_text(self, counter, text):
+        # The text display rotates through the counters by itself, so it
+        # only needs updating when something changes
+        with self._display_lock:
+            if text != counter['text']:
+                counter['text'] = text
+                showing = [i for i, c in enumerate(self._counters) if c['text'] is not None]
+                self._display.rotate([self._counters[i]['label'] + str(self._counters[i]['text']) for i in showing],
+                                     self.DELAY, keys=showing)
+
+    def _cache(self):
+        with self._url_cache_lock:
+            if self._url_cache is None:
+                from url_cache import UrlCache
+                self._url_cache = UrlCache(self._config.get('url_cache_size', UrlCache.MAX_ENTRIES))
+
+            return self._url_cache
+
+    def _url_cache_stats(self):
+        return self._url_cache.stats() if self._url_cache is not None else dict()
+
+    def get_url(self, url, headers=None, timeout=None):
+        return self._cache().get(url, headers, self._url_delays.get(url, 0), timeout or self.DEFAULT_TIMEOUT)
+
+    def get_json_url(self, url, headers=None, timeout=None):
+        return self._cache().get_json(url, headers, self._url_delays.get(url, 0), timeout or self.DEFAULT_TIMEOUT)
+
+    def _receive(self, name, value):
+        # A value pushed through the listener. Numbers are shown like the
+        # number sources show them, anything else as it is.
+        if name in self._push_names:
+            try:
+                text = counter_sources.format_number(value)
+            except ValueError:
+                text = value
+
+            self._pushed_values[name] = text
+            for index in self._push_names[name]:
+                self._counters[index]['pushed_at'] = time.monotonic()
+                self._set_text(self._counters[index], text)
+
+    def pushed_value(self, name):
+        return self._pushed_values.get(name)
+
+    def push(self, method, key, text):
+        # For sources that learn of changes themselves: sets the text of
+        # the counters of this method whose params start with key
+        for c in self._counters:
+            if c['method'] == method and tuple(c['params'][:len(key)]) == key:
+                self._set_text(c, text)
@@ -0,0 +1,198 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+from threading import Lock
+
+
+class _Inotify():
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ONLYDIR = 0x01000000
+
+    WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self._watches = dict()
+        self._paths = dict()
+
+    def watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+
+        # A directory moved within the tree keeps its watch, so the old path
+        # no longer owns it
+        old_path = self._watches.get(wd)
+        if old_path is not None and old_path != path:
+            self._paths.pop(old_path, None)
+
+        self._watches[wd] = path
+        self._paths[path] = wd
+
+    def unwatch(self, path):
+        wd = self._paths.pop(path, None)
+        if wd is not None and self._watches.get(wd) == path:
+            del self._watches[wd]
+            # The watch is already gone if the directory was deleted
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def changed_paths(self):
+        # Returns the set of watched directories with changes, or None if
+        # the kernel queue overflowed and everything needs checking
+        changed = set()
+
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self._EVENT.unpack_from(data, offset)
+                offset += self._EVENT.size + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                if wd in self._watches:
+                    changed.add(self._watches[wd])
+
+    def close(self):
+        os.close(self._fd)
+
+
+class DirCounter():
+    # Counts the non-hidden files and directories below a path, matching
+    # glob('path/**', recursive=True). Each directory's direct count is cached
+    # and only directories that changed are listed again.
+
+    def __init__(self, path):
+        self._path = path
+        self._dirs = dict()
+        self._count = 0
+        # Counters on the same path share this across their workers
+        self._lock = Lock()
+
+        try:
+            self._inotify = _Inotify()
+        except Exception:
+            # No inotify here, so fall back to checking directory mtimes
+            self._inotify = None
+
+        try:
+            self._scan_tree(path)
+        except Exception:
+            self._close_inotify()
+            raise
+
+    def count(self):
+        with self._lock:
+            if self._inotify is not None:
+                changed = self._inotify.changed_paths()
+            else:
+                changed = set()
+                for path, (mtime, _, _) in self._dirs.items():
+                    try:
+                        if os.stat(path).st_mtime_ns != mtime:
+                            changed.add(path)
+                    except FileNotFoundError:
+                        changed.add(path)
+
+            if changed is None:
+                changed = set(self._dirs.keys())
+
+            # Parents first, so removed subtrees are dropped before we look at them
+            for path in sorted(changed, key=len):
+                if path in self._dirs:
+                    self._rescan(path)
+
+            return self._count
+
+    def close(self):
+        with self._lock:
+            self._close_inotify()
+
+    def _close_inotify(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _scan_tree(self, path):
+        for subdir in self._scan_dir(path):
+            self._scan_tree(subdir)
+
+    def _scan_dir(self, path):
+        if self._inotify is not None and path not in self._dirs:
+            # Watch before listing so nothing created in between is missed
+            try:
+                self._inotify.watch(path)
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                # Usually out of watches (ENOSPC), so check directory mtimes
+                # instead. They were recorded as each directory was listed,
+                # so changes since then will still be seen.
+                print(f'Checking {self._path} by mtime: {e}')
+                self._close_inotify()
+
+        mtime = os.stat(path).st_mtime_ns
+        direct = 0
+        subdirs = list()
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+
+                direct += 1
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+
+        self._forget(path)
+        self._dirs[path] = (mtime, direct, subdirs)
+        self._count += direct
+        return subdirs
+
+    def _rescan(self, path):
+        old_subdirs = set(self._dirs[path][2])
+
+        try:
+            subdirs = self._scan_dir(path)
+        except FileNotFoundError:
+            self._remove_tree(path)
+            if path == self._path:
+                raise
+            return
+
+        for subdir in old_subdirs.difference(subdirs):
+            self._remove_tree(subdir)
+
+        for subdir in subdirs:
+            if subdir not in self._dirs:
+                self._scan_tree(subdir)
+
+    def _forget(self, path):
+        if path in self._dirs:
+            self._count -= self._dirs[path][1]
+            del self._dirs[path]
+
+    def _remove_tree(self, path):
+        if path in self._dirs:
+            subdirs = self._dirs[path][2]
+            self._forget(path)
+            if self._inotify is not None:
+                self._inotify.unwatch(path)
+
+            for subdir in subdirs:
+                self._remove_tree(subdir)
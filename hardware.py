@@ -0,0 +1,123 @@
+from threading import Lock
+import time
+
+# Display backends. The real ones import the Adafruit and board libraries
+# only when they're created, so everything else runs off a Pi against the
+# simulated ones, which record every I2C transaction they would have made.
+
+# Matrix colours, with the same values as Adafruit_LED_Backpack.BicolorMatrix8x8
+OFF = 0
+GREEN = 1
+RED = 2
+YELLOW = 3
+
+
+class TransactionLog():
+    def __init__(self):
+        self._lock = Lock()
+        self.transactions = list()
+
+    def record(self, device, register, data):
+        with self._lock:
+            self.transactions.append((time.monotonic(), device, register, bytes(data)))
+
+    def since(self, start, device=None):
+        with self._lock:
+            return [t for t in self.transactions if t[0] >= start and (device is None or t[1] == device)]
+
+    def clear(self):
+        with self._lock:
+            self.transactions = list()
+
+
+class MatrixBackend():
+    def __init__(self, address, busnum):
+        from Adafruit_LED_Backpack import BicolorMatrix8x8
+
+        self._matrix = BicolorMatrix8x8.BicolorMatrix8x8(address=address, busnum=busnum)
+        self._matrix.begin()
+
+    def set_brightness(self, brightness):
+        self._matrix.set_brightness(brightness)
+
+    def write_block(self, register, data):
+        self._matrix._device.writeList(register, list(data))
+
+
+class SimulatedMatrix():
+    def __init__(self, address, log):
+        self._address = address
+        self._log = log
+        self.ram = bytearray(16)
+
+    def set_brightness(self, brightness):
+        self._log.record(self._address, 'brightness', [brightness])
+
+    def write_block(self, register, data):
+        self.ram[register:register + len(data)] = data
+        self._log.record(self._address, register, data)
+
+
+class SegmentBackend():
+    def __init__(self, address):
+        import board
+        from adafruit_ht16k33.segments import Seg14x4
+
+        self._display = Seg14x4(board.I2C(), address=address, auto_write=False)
+
+    def set_brightness(self, brightness):
+        self._display.brightness = brightness
+
+    def set_digit_raw(self, digit, bitmask):
+        self._display.set_digit_raw(digit, bitmask)
+
+    def show(self):
+        self._display.show()
+
+
+class SimulatedSegments():
+    def __init__(self, address, log):
+        self._address = address
+        self._log = log
+        self.digits = [0, 0, 0, 0]
+
+    def set_brightness(self, brightness):
+        self._log.record(self._address, 'brightness', [int(brightness * 15)])
+
+    def set_digit_raw(self, digit, bitmask):
+        self.digits[digit] = bitmask
+
+    def show(self):
+        # Seg14x4.show() sends the whole display buffer in one write
+        self._log.record(self._address, 0, self.to_buffer(self.digits))
+
+    @staticmethod
+    def to_buffer(digits):
+        data = bytearray()
+        for bitmask in digits:
+            data += bytes([bitmask & 0xFF, (bitmask >> 8) & 0xFF])
+        return data
+
+
+# Shared by all simulated devices in the process
+log = TransactionLog()
+
+
+def create_matrix(config):
+    if config.get('simulate', False):
+        return SimulatedMatrix(config['address'], log)
+    else:
+        return MatrixBackend(config['address'], config['i2c_bus'])
+
+
+def create_segments(config):
+    if config.get('simulate', False):
+        return SimulatedSegments(config['address'], log)
+    else:
+        return SegmentBackend(config['address'])
+
+
+def segment_chars():
+    # Segment patterns for ASCII 32-127, two bytes per character, as used by Seg14x4
+    from adafruit_ht16k33.segments import CHARS
+    return CHARS
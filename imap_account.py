@@ -0,0 +1,198 @@
+import imaplib
+import re
+import select
+from threading import Event, Lock, Thread
+import time
+import traceback
+
+
+class ImapAccount():
+    # RFC 2177 says servers may drop IDLE after 30 minutes, so restart it before then
+    IDLE_RESTART = 25 * 60
+    RECONNECT_DELAY = 5
+    MAX_RECONNECT_DELAY = 300
+
+    _UNSEEN = re.compile(rb'UNSEEN (\d+)')
+    _COUNT = re.compile(rb'COUNT (\d+)')
+    _MAILBOX_CHANGE = re.compile(rb'\* \d+ (EXISTS|EXPUNGE|FETCH|RECENT)')
+
+    def __init__(self, server, email, password, timeout, on_change=None):
+        self._server = server
+        self._email = email
+        self._password = password
+        self._timeout = timeout
+        self._on_change = on_change
+
+        self._mail = None
+        self._selected = False
+        self._lock = Lock()
+        self._stop = Event()
+        self._idle_thread = None
+
+        # True while the connection is in IDLE, and the IDLE thread is
+        # keeping the count up to date
+        self._idling = False
+        self._idle_tag = None
+
+        self.unseen = None
+
+    def unread(self):
+        with self._lock:
+            if self._idling:
+                return self.unseen
+
+            if self._mail is None:
+                self._connect()
+            else:
+                try:
+                    self.unseen = self._status()
+                except (imaplib.IMAP4.abort, OSError):
+                    # Connection went stale between refreshes, so try once more on a new one
+                    self._connect()
+
+            return self.unseen
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            self._disconnect()
+
+    def _connect(self):
+        self._disconnect()
+
+        try:
+            self._mail = imaplib.IMAP4_SSL(self._server, timeout=self._timeout)
+            self._mail.login(self._email, self._password)
+
+            # Servers only report changes to the selected mailbox during IDLE
+            result, data = self._mail.select('INBOX', readonly=True)
+            if result != 'OK':
+                raise imaplib.IMAP4.error(f'EXAMINE failed: {data}')
+            self._selected = True
+
+            self.unseen = self._status()
+        except Exception:
+            self._disconnect()
+            raise
+
+        if 'IDLE' in self._mail.capabilities and self._idle_thread is None:
+            self._idle_thread = Thread(target=self._idle_loop, name='imap_idle', daemon=True)
+            self._idle_thread.start()
+
+    def _disconnect(self):
+        if self._mail is not None:
+            try:
+                self._mail.logout()
+            except Exception:
+                pass
+            self._mail = None
+            self._selected = False
+
+    def _status(self):
+        # STATUS shouldn't be used on the selected mailbox (RFC 3501 6.3.10),
+        # and some servers give stale counts if it is, so search it instead
+        if self._selected:
+            return self._search_unseen()
+
+        result, data = self._mail.status('INBOX', '(UNSEEN)')
+        if result != 'OK':
+            raise imaplib.IMAP4.error(f'STATUS failed: {data}')
+
+        return int(self._UNSEEN.search(data[0]).group(1))
+
+    def _search_unseen(self):
+        mail = self._mail
+        if 'ESEARCH' in mail.capabilities:
+            # Just the count, rather than every unseen message number (RFC 4731)
+            result, data = mail._simple_command('SEARCH', 'RETURN (COUNT)', 'UNSEEN')
+            if result != 'OK':
+                raise imaplib.IMAP4.error(f'SEARCH failed: {data}')
+
+            result, data = mail._untagged_response(result, data, 'ESEARCH')
+            match = self._COUNT.search(data[0] or b'')
+            return int(match.group(1)) if match is not None else 0
+
+        result, data = mail.search(None, 'UNSEEN')
+        if result != 'OK':
+            raise imaplib.IMAP4.error(f'SEARCH failed: {data}')
+
+        return len(data[0].split())
+
+    def _idle_loop(self):
+        reconnect_delay = self.RECONNECT_DELAY
+
+        while not self._stop.is_set():
+            try:
+                with self._lock:
+                    if self._mail is None:
+                        self._connect()
+                        self._notify()
+
+                    if not self._start_idle():
+                        # Leave unread() to poll the count instead
+                        return
+
+                self._idle()
+
+                # Check the count after every IDLE, including the periodic
+                # restarts, in case a change notification was missed
+                with self._lock:
+                    self._idling = False
+                    unseen = self._status()
+                if unseen != self.unseen:
+                    self.unseen = unseen
+                    self._notify()
+
+                reconnect_delay = self.RECONNECT_DELAY
+            except Exception:
+                print(traceback.format_exc())
+                with self._lock:
+                    self._idling = False
+                    self._disconnect()
+                self._stop.wait(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, self.MAX_RECONNECT_DELAY)
+
+    def _start_idle(self):
+        # imaplib has no IDLE support before Python 3.14, so speak it directly.
+        # Returns False if the server won't IDLE.
+        mail = self._mail
+        self._idle_tag = mail._new_tag()
+        mail.send(self._idle_tag + b' IDLE\r\n')
+
+        response = mail.readline()
+        while response.startswith(b'* '):
+            # Untagged updates can arrive before the continuation
+            response = mail.readline()
+        if not response:
+            raise imaplib.IMAP4.abort('Connection closed starting IDLE')
+        if not response.startswith(b'+'):
+            print(f'IDLE rejected by {self._server}: {response}')
+            return False
+
+        self._idling = True
+        return True
+
+    def _idle(self):
+        # Waits in IDLE until the mailbox changes or it's time to restart
+        mail = self._mail
+        changed = False
+        deadline = time.monotonic() + self.IDLE_RESTART
+        while not changed and not self._stop.is_set() and time.monotonic() < deadline:
+            readable, _, _ = select.select([mail.sock], [], [], min(self._timeout, deadline - time.monotonic()))
+            if readable or mail.sock.pending():
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort('Connection closed during IDLE')
+                changed = self._MAILBOX_CHANGE.match(line) is not None
+
+        mail.send(b'DONE\r\n')
+        while True:
+            line = mail.readline()
+            if not line:
+                raise imaplib.IMAP4.abort('Connection closed ending IDLE')
+            if line.startswith(self._idle_tag):
+                break
+
+    def _notify(self):
+        if self._on_change is not None:
+            self._on_change(self.unseen)
@@ -0,0 +1,166 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+from threading import Lock, Thread
+import threading
+import time
+import traceback
+
+# Latency histograms and scrape-time gauges for the whole program, served
+# as Prometheus text. Recording an observation is a bisect and two
+# increments. Everything else, such as per-thread CPU, cache hit counts and
+# queue depths, is only read when the endpoint is scraped.
+
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Metrics():
+    def __init__(self):
+        self._histograms = dict()
+        self._gauges = list()
+        self._lock = Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, help_text, callback, kind='gauge'):
+        # callback returns a number, or a list of (labels, value) pairs, and
+        # is only called when the metrics are scraped
+        with self._lock:
+            self._gauges.append((name, help_text, callback, kind))
+
+    def render(self):
+        lines = list()
+
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            gauges = list(self._gauges)
+
+        last_name = None
+        for (name, labels), histogram in histograms:
+            if name != last_name:
+                lines.append(f'# TYPE {name} histogram')
+                last_name = name
+
+            counts, total = histogram.snapshot()
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", bound), ))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+
+        for name, help_text, callback, kind in gauges:
+            try:
+                values = callback()
+            except Exception:
+                print(traceback.format_exc())
+                continue
+
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if not isinstance(values, list):
+                values = [(dict(), values)]
+            for labels, value in values:
+                lines.append(f'{name}{_labels(tuple(sorted(labels.items())))} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _thread_cpu():
+    # CPU seconds used by each live thread, from /proc on Linux
+    ticks = os.sysconf('SC_CLK_TCK')
+    values = list()
+
+    for thread in threading.enumerate():
+        try:
+            with open(f'/proc/self/task/{thread.native_id}/stat') as stat:
+                # Fields after the command, which may contain spaces
+                fields = stat.read().rsplit(')', 1)[1].split()
+            values.append(({'thread': thread.name}, (int(fields[11]) + int(fields[12])) / ticks))
+        except (OSError, IndexError, TypeError):
+            pass
+
+    return values
+
+
+# Shared by the whole process
+registry = Metrics()
+registry.gauge('process_cpu_seconds_total', 'CPU time used by the process', time.process_time, 'counter')
+registry.gauge('thread_cpu_seconds_total', 'CPU time used by each thread', _thread_cpu, 'counter')
+
+observe = registry.observe
+timer = registry.timer
+gauge = registry.gauge
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(config):
+    # Serves /metrics on localhost, if a port is configured
+    if not config.get('port'):
+        return None
+
+    server = ThreadingHTTPServer((config.get('host', '127.0.0.1'), config['port']), _Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
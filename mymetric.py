@@ -1,27 +1,42 @@
 import alerts
 import bcmatrix
+import compositor
 import counters
+import metrics
 import rtm
+import state_publisher
 import text_display
 import toml
+import uptime_robot
 
 with open('config.toml') as config_file:
     config = toml.load(config_file)
 
 
-# Displays
-matrix = bcmatrix.bcmatrix(config['matrix'])
-text = text_display.text_display(config['text'])
+# Timings and gauges, served on localhost for Prometheus
+metrics.start_server(config.get('metrics', dict()))
+
+# Displays, both driven by a single render thread
+compositor = compositor.Compositor()
+matrix = bcmatrix.bcmatrix(config['matrix'], compositor)
+text = text_display.text_display(config['text'], compositor)
+
+# Shared state, such as the task count
+publisher = state_publisher.StatePublisher(config.get('state'))
 
 # RememberTheMilk
-rtm = rtm.RTM(matrix, config['rtm'])
+rtm = rtm.RTM(matrix, config['rtm'], publisher)
 
 # Counters
-counters = counters.Counters(text, config['counters'])
+counters = counters.Counters(text, config['counters'], publisher)
 
 # Alerts
 alerts = alerts.Alerts(config['alerts'], matrix, text)
 
+# UptimeRobot incidents, raised as alerts
+if config.get('uptime_robot', dict()).get('api_key'):
+    uptime = uptime_robot.UptimeRobot(config['uptime_robot'], alerts.add_alerts)
+
 # Pass around shared objects
 rtm.register_alerts(alerts)
 counters.register_alerts(alerts)
@@ -1,62 +1,203 @@
-from Adafruit_LED_Backpack import BicolorMatrix8x8
+import hardware
+from bcmatrix import Frame
+from compositor import Compositor
+from state_publisher import StatePublisher
 import copy
-from datetime import datetime, timedelta
-from dateutil import parser
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from hashlib import md5
 import logging
 import math
-from operator import itemgetter
+import metrics
+import os
 import requests
 from requests.adapters import HTTPAdapter
-from threading import Thread
+import struct
+from threading import Event, Lock, Thread
 import time
 import traceback
 from tzlocal import get_localzone
+from urllib.parse import quote, urlencode
 from urllib3.util.retry import Retry
 
 
+class _Task():
+    __slots__ = ('due', 'recurring')
+
+    def __init__(self, due, recurring):
+        # Due date as a proleptic Gregorian ordinal in local time
+        self.due = due
+        self.recurring = recurring
+
+    def __eq__(self, other):
+        return isinstance(other, _Task) and self.due == other.due and self.recurring == other.recurring
+
+
+class _TokenBucket():
+    def __init__(self, capacity, rate):
+        self._capacity = capacity
+        self._rate = rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def take(self):
+        # Wait for a token and take it
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+            if self._tokens < 1:
+                time.sleep((1 - self._tokens) / self._rate)
+                self._tokens = 1
+                self._updated = time.monotonic()
+
+            self._tokens -= 1
+
+
 class RTM():
     _RTM_URL = 'https://api.rememberthemilk.com/services/rest/?'
-    _RATE_LIMIT = 50
-    _RATE_LIMIT_BACKOFF = 15
+    _REQUESTS_PER_HOUR = 120
+    _REQUEST_BURST = 5
+    _POLL_INTERVAL = 60
+    _MIDNIGHT_INTERVAL = 15
+    _MIDNIGHT_WINDOW = 300
+    _MAX_BACKOFF = 900
+    _CONNECT_TIMEOUT = 10
+    _READ_TIMEOUT = 30
+    _POOL_SIZE = 2
+    _FULL_SYNC_INTERVAL = 86400
+    _DUE_WINDOW_DAYS = 3
+    _DUE_CACHE_SIZE = 1024
     _ALL_TASKS = '_all'
-    _OVERDUE = -1
-    _TODAY = 0
-    _FUTURE = 1
+    _CACHE_FILE = 'task_cache.bin'
+    _COUNT_FILE = 'task_count.txt'
+    _STALE_BLINK = 1
+
+    # Task cache layout: header, then one record per task followed by its
+    # list, taskseries and task ids as length-prefixed UTF-8
+    _CACHE_MAGIC = b'RTMC'
+    _CACHE_VERSION = 1
+    _CACHE_HEADER = struct.Struct('<4sHddI')
+    _CACHE_RECORD = struct.Struct('<iB')
+    _CACHE_STRING = struct.Struct('<H')
 
     # Pre-defined symbols
     _NETWORK_ERROR = [[0, 7], [1, 7], [2, 7], [3, 7], [1, 6], [2, 5], [3, 4], [2, 4], [1, 4], [0, 4]]
     _GENERIC_ERROR = [[0, 7], [1, 7], [2, 7], [3, 7], [4, 7], [0, 6], [0, 5], [2, 6], [4, 6], [4, 5]]
 
-    def __init__(self, matrix, config):
+    def __init__(self, matrix, config, publisher=None, session=None):
         self._matrix = matrix
+        self._publisher = publisher if publisher is not None else StatePublisher()
 
         self._key = config['api_key']
         self._secret = config['shared_secret']
         self._token = config['token']
 
-        self._tasks = list()
+        self._timeout = (config.get('connect_timeout', self._CONNECT_TIMEOUT),
+                         config.get('read_timeout', self._READ_TIMEOUT))
+
+        # One keep-alive session for the lifetime of the object so we don't
+        # pay for a new TCP/TLS handshake on every poll. The benchmark passes
+        # in its own to replay recorded responses.
+        if session is None:
+            session = requests.Session()
+            retry = Retry(connect=5, backoff_factor=0.5)
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=1,
+                                  pool_maxsize=config.get('pool_size', self._POOL_SIZE), pool_block=True)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self._session = session
+
+        # The shared secret always starts the signature, and the key and token
+        # sort first among the params on every call, so hash them once and
+        # copy the state
+        self._sig_base = md5(self._secret.encode('utf-8'))
+        self._sig_prefix = (('api_key', str(self._key)), ('auth_token', str(self._token)))
+        self._sig_prefix_state = self._sig_base.copy()
+        for (key, value) in self._sig_prefix:
+            self._sig_prefix_state.update(f'{key}{value}'.encode('utf-8'))
+
+        self._incremental = config.get('incremental_sync', True)
+        self._task_store = dict()
+        self._last_sync = None
+        self._last_full_sync = None
+
+        self._localzone = get_localzone()
+        self._local_day = lru_cache(maxsize=self._DUE_CACHE_SIZE)(self._parse_local_day)
+
+        self._counts = None
+        self._stale = True
         self._last_request = None
         self._last_request_status = None
         self._processing_error = False
 
         self._alerts = None
 
-        Thread(target=self._run, ).start()
+        # RTM allows an average of one call a second. We budget far less than
+        # that and spend it on polling faster when it's useful.
+        self._bucket = _TokenBucket(self._REQUEST_BURST, config.get('requests_per_hour', self._REQUESTS_PER_HOUR) / 3600)
+        self._poll_interval = config.get('poll_interval', self._POLL_INTERVAL)
+        self._failures = 0
+        self._refresh_event = Event()
+
+        # Paint whatever we knew last time straight away
+        self._cache_file = config.get('cache_file', self._CACHE_FILE)
+        self._load_cache()
+        self.display_tasks()
+
+        metrics.gauge('rtm_tasks', 'Tasks in the local store', lambda: len(self._task_store))
+        metrics.gauge('rtm_cache_hits_total', 'Hits in the RTM lookup caches', lambda: [
+            ({'cache': 'due_date'}, self._local_day.cache_info().hits)], 'counter')
+        metrics.gauge('rtm_cache_misses_total', 'Misses in the RTM lookup caches', lambda: [
+            ({'cache': 'due_date'}, self._local_day.cache_info().misses)], 'counter')
+
+        Thread(target=self._run, name='rtm').start()
 
     def _run(self):
         while True:
-            self._fetch_tasks()
-            if self._alerts is None or not self._alerts.showing_alert:
-                self.display_tasks()
-            time.sleep(60)
+            self._refresh_event.clear()
+            if self._fetch_tasks():
+                self._failures = 0
+                self._stale = False
+            else:
+                self._failures += 1
+                self._stale = True
+
+            # Recount even if the fetch failed, so tasks still move between
+            # future, today and overdue when the day changes
+            if self._counts is not None:
+                self._counts = self._count_tasks()
+            self.display_tasks()
+
+            self._refresh_event.wait(self._next_poll_delay())
+
+    def _next_poll_delay(self):
+        now = datetime.now(self._localzone)
+        seconds_since_midnight = (now - self._midnight(now)).total_seconds()
+
+        if self._failures > 0:
+            # Still wake up at midnight to recount the tasks we have
+            return min(self._poll_interval * 2 ** (self._failures - 1), self._MAX_BACKOFF,
+                       86400 - seconds_since_midnight + 1)
+
+        # Poll more often around midnight, when tasks move from future to today to overdue
+        if min(seconds_since_midnight, 86400 - seconds_since_midnight) < self._MIDNIGHT_WINDOW:
+            return min(self._poll_interval, self._MIDNIGHT_INTERVAL)
+
+        return self._poll_interval
+
+    def refresh(self):
+        # Poll now rather than waiting for the next scheduled poll. The
+        # request budget still applies.
+        self._refresh_event.set()
 
     def register_alerts(self, alerts):
         self._alerts = alerts
 
     def _request(self, method, params):
-        if self._last_request is not None and (datetime.now() - self._last_request).seconds < self._RATE_LIMIT:
-            time.sleep(self._RATE_LIMIT_BACKOFF)
+        self._bucket.take()
 
         request_params = copy.deepcopy(params)
         request_params['method'] = method
@@ -64,122 +205,250 @@ class RTM():
         request_params['auth_token'] = self._token
         request_params['format'] = 'json'
 
-        request_params = dict(sorted(request_params.items()))
+        request_string = self._signed_url(tuple(sorted((key, str(value)) for key, value in request_params.items())))
 
-        request_string = self._RTM_URL
-        sig = self._secret
-        for (key, value) in request_params.items():
-            request_string += f'{key}={value}&'
-            sig += f'{key}{value}'
-
-        request_string += f'api_sig={md5(sig.encode("utf-8")).hexdigest()}'
-        
-        session = requests.Session()
-        retry = Retry(connect=5, backoff_factor=0.5)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-
-        response = session.get(request_string)
+        with metrics.timer('rtm_request_seconds', method=method):
+            response = self._session.get(request_string, timeout=self._timeout)
         self._last_request_status = response.status_code
         self._last_request = datetime.now()
 
         return response.json() if response.status_code == 200 else None
 
+    def _signed_url(self, sorted_params):
+        prefix = len(self._sig_prefix)
+        if sorted_params[:prefix] == self._sig_prefix:
+            sig = self._sig_prefix_state.copy()
+        else:
+            sig = self._sig_base.copy()
+            prefix = 0
+
+        for (key, value) in sorted_params[prefix:]:
+            sig.update(f'{key}{value}'.encode('utf-8'))
+
+        return f'{self._RTM_URL}{urlencode(sorted_params, quote_via=quote)}&api_sig={sig.hexdigest()}'
+
+    def close(self):
+        self._session.close()
+
     def _fetch_tasks(self):
         try:
+            sync_time = datetime.now(timezone.utc)
+            incremental = self._incremental and self._last_sync is not None \
+                and (sync_time - self._last_full_sync).total_seconds() < self._FULL_SYNC_INTERVAL
+
             params = dict()
-            params['filter'] = 'status:incomplete AND dueBefore:"3 days of self._TODAY"'
+            if incremental:
+                params['last_sync'] = self._last_sync
+            elif self._incremental:
+                # The due window is applied locally so that tasks moving into it
+                # are already in the store when they get there
+                params['filter'] = 'status:incomplete'
+            else:
+                params['filter'] = 'status:incomplete AND dueBefore:"3 days of self._TODAY"'
 
             raw_tasks = self._request('rtm.tasks.getList', params)
 
-            if raw_tasks is None:
-                self._tasks = None
-            else:
-                task_list = list()
+            # On failure we keep the last good tasks and show them as stale
+            if raw_tasks is not None:
+                # Build the new store on the side, so a response we can't
+                # parse leaves the last good tasks in place
+                task_store = dict(self._task_store) if incremental else dict()
+
+                with metrics.timer('rtm_parse_seconds'):
+                    self._apply_task_lists(task_store, self._as_list(raw_tasks['rsp']['tasks'].get('list')))
+
+                    changed = task_store != self._task_store
+                    self._task_store = task_store
+                    if not incremental:
+                        self._last_full_sync = sync_time
+                    if self._incremental:
+                        self._last_sync = sync_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+                    self._counts = self._count_tasks()
+                if changed:
+                    self._save_cache()
+            self._processing_error = False
+        except Exception as e:
+            self._processing_error = True
+            # Start again from a clean full sync if the response didn't make
+            # sense. After a network error the last sync still stands.
+            if not isinstance(e, requests.RequestException) or isinstance(e, requests.JSONDecodeError):
+                self._last_sync = None
+            logging.error(traceback.format_exc())
 
-                self._TODAY = self._midnight(datetime.now(get_localzone())).date()
+        return not self._processing_error and self._last_request_status == 200
 
-                task_series = raw_tasks['rsp']['tasks']['list']
+    def _apply_task_lists(self, task_store, task_lists):
+        for task_list in task_lists:
+            list_id = task_list['id']
 
-                for series in task_series:
-                    for task in series['taskseries']:
-                        recurring = 'rrule' in task
-                        task_name = task['name']
+            for series in self._as_list(task_list.get('taskseries')):
+                recurring = 'rrule' in series
 
-                        for task_entry in task['task']:
-                            entry_date = parser.parse(task_entry['due'])
-                            local_date = self._midnight(entry_date.astimezone(get_localzone())).date()
+                for task_entry in self._as_list(series['task']):
+                    key = (list_id, series['id'], task_entry['id'])
 
-                            if local_date < self._TODAY:
-                                status = self._OVERDUE
-                            elif local_date == self._TODAY:
-                                status = self._TODAY
-                            else:
-                                status = self._FUTURE
+                    if task_entry.get('completed', '') != '' or task_entry.get('deleted', '') != '' \
+                            or task_entry['due'] == '':
+                        task_store.pop(key, None)
+                    else:
+                        task_store[key] = _Task(self._local_day(task_entry['due']), recurring)
 
-                            task_item = dict()
-                            task_item['due'] = local_date.strftime("%Y-%m-%d")
-                            task_item['status'] = status
-                            task_item['recurring'] = recurring
+            for deleted in self._as_list(task_list.get('deleted')):
+                for series in self._as_list(deleted.get('taskseries')):
+                    for task_entry in self._as_list(series.get('task')):
+                        task_store.pop((list_id, series['id'], task_entry['id']), None)
 
-                            task_list.append(task_item)
+    def _count_tasks(self):
+        today = datetime.now(self._localzone).date().toordinal()
+        window_end = today + self._DUE_WINDOW_DAYS if self._incremental else None
 
-                self._tasks = sorted(task_list, key=itemgetter('due'))
-            self._processing_error = False
-        except Exception as e:
-            self._processing_error = True
-            logging.error(traceback.format_exc())
+        overdue = 0
+        due_today = 0
+        future = 0
+
+        for task in self._task_store.values():
+            if task.due < today:
+                overdue += 1
+            elif task.due == today:
+                due_today += 1
+            elif window_end is None or task.due < window_end:
+                future += 1
+
+        return overdue, due_today, future
+
+    def _parse_local_day(self, due):
+        try:
+            entry_date = datetime.fromisoformat(due)
+        except ValueError:
+            # Only older Pythons need dateutil, so only load it if we get here
+            from dateutil import parser
+            entry_date = parser.parse(due)
+
+        return entry_date.astimezone(self._localzone).date().toordinal()
+
+    @staticmethod
+    def _as_list(value):
+        if value is None:
+            return list()
+        elif isinstance(value, list):
+            return value
+        else:
+            return [value]
 
 
     def display_tasks(self):
-        if self._last_request_status is not None and self._last_request_status != 200:
-            self._display_network_error()
-        elif self._processing_error:
-            self._display_symbol(self._GENERIC_ERROR, BicolorMatrix8x8.RED)
+        frame = Frame()
+
+        if self._counts is None:
+            # Nothing to fall back on, so show what went wrong
+            if self._last_request_status is not None and self._last_request_status != 200:
+                self._display_network_error(frame)
+            elif self._processing_error:
+                self._display_symbol(frame, self._GENERIC_ERROR, hardware.RED)
+
+            self._matrix.render(frame, Compositor.TASKS)
         else:
-            overdue = 0
-            today = 0
-            future = 0
-
-            for task in self._tasks:
-                if task['status'] == self._OVERDUE:
-                    overdue += 1
-                elif task['status'] == self._TODAY:
-                    today += 1
-                else:
-                    future += 1
-
-            self._draw_tasks(overdue, today, future)
-            with open('task_count.txt', 'w') as count_file:
-                count_file.write(f'{overdue + today + future}')
-
-    def _display_symbol(self, points, color):
+            overdue, today, future = self._counts
+
+            self._draw_tasks(frame, overdue, today, future)
+            self._publisher.publish('task_count', overdue + today + future, self._COUNT_FILE)
+
+            if self._stale:
+                # Blink the bottom right pixel while the counts are out of date
+                marked = frame.copy()
+                marked.set_pixel(0, 0, hardware.RED)
+                self._matrix.animate([frame, marked], self._STALE_BLINK, Compositor.TASKS)
+            else:
+                self._matrix.render(frame, Compositor.TASKS)
+
+    def _load_cache(self):
+        try:
+            with open(self._cache_file, 'rb') as cache:
+                data = cache.read()
+        except FileNotFoundError:
+            return
+
+        try:
+            magic, version, last_sync, last_full_sync, count = self._CACHE_HEADER.unpack_from(data)
+            if magic != self._CACHE_MAGIC or version != self._CACHE_VERSION:
+                return
+
+            offset = self._CACHE_HEADER.size
+            task_store = dict()
+            for i in range(count):
+                due, recurring = self._CACHE_RECORD.unpack_from(data, offset)
+                offset += self._CACHE_RECORD.size
+
+                key = list()
+                for j in range(3):
+                    length, = self._CACHE_STRING.unpack_from(data, offset)
+                    offset += self._CACHE_STRING.size
+                    key.append(data[offset:offset + length].decode('utf-8'))
+                    offset += length
+
+                task_store[tuple(key)] = _Task(due, recurring == 1)
+
+            self._task_store = task_store
+            if self._incremental and last_sync > 0:
+                self._last_sync = datetime.fromtimestamp(last_sync, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+                self._last_full_sync = datetime.fromtimestamp(last_full_sync, timezone.utc)
+            self._counts = self._count_tasks()
+        except Exception:
+            logging.error(traceback.format_exc())
+
+    def _save_cache(self):
+        last_sync = 0
+        if self._last_sync is not None:
+            last_sync = datetime.strptime(self._last_sync, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+        last_full_sync = self._last_full_sync.timestamp() if self._last_full_sync is not None else 0
+
+        data = bytearray(self._CACHE_HEADER.pack(self._CACHE_MAGIC, self._CACHE_VERSION, last_sync, last_full_sync,
+                                                 len(self._task_store)))
+        for key, task in self._task_store.items():
+            data += self._CACHE_RECORD.pack(task.due, 1 if task.recurring else 0)
+            for value in key:
+                encoded = str(value).encode('utf-8')
+                data += self._CACHE_STRING.pack(len(encoded))
+                data += encoded
+
+        # Write alongside and rename, so a reader never sees a partial file
+        try:
+            temp_file = f'{self._cache_file}.tmp'
+            with open(temp_file, 'wb') as cache:
+                cache.write(data)
+                cache.flush()
+                os.fsync(cache.fileno())
+            os.replace(temp_file, self._cache_file)
+        except OSError:
+            logging.error(traceback.format_exc())
+
+    def _display_symbol(self, frame, points, color):
         for point in points:
-            self._matrix.set_pixel(point[0], point[1], color)
+            frame.set_pixel(point[0], point[1], color)
 
-    def _display_vertical_binary(self, column, number, color):
+    def _display_vertical_binary(self, frame, column, number, color):
         for bit in range(8):
             if 1 << bit & number:
-                self._matrix.set_pixel(7 - bit, column, color)
+                frame.set_pixel(7 - bit, column, color)
 
-    def _display_network_error(self):
-        self._display_symbol(self._NETWORK_ERROR, BicolorMatrix8x8.RED)
+    def _display_network_error(self, frame):
+        self._display_symbol(frame, self._NETWORK_ERROR, hardware.RED)
 
         print(self._last_request_status)
         hundreds = int(self._last_request_status / 100)
         rest = self._last_request_status % 100
-        self._display_vertical_binary(1, hundreds, BicolorMatrix8x8.YELLOW)
-        self._display_vertical_binary(0, rest, BicolorMatrix8x8.YELLOW)
+        self._display_vertical_binary(frame, 1, hundreds, hardware.YELLOW)
+        self._display_vertical_binary(frame, 0, rest, hardware.YELLOW)
 
-    def _display_binary_tasks(self, count, start_row, color):
+    def _display_binary_tasks(self, frame, count, start_row, color):
         for bit in range(8):
             if 1 << bit & count:
-                self._matrix.set_pixel(start_row, 7 - bit, color)
+                frame.set_pixel(start_row, 7 - bit, color)
 
         for bit in range(8, 16):
             if 1 << bit & count:
-                self._matrix.set_pixel(start_row - 1, 15 - bit, color)
+                frame.set_pixel(start_row - 1, 15 - bit, color)
 
     @staticmethod
     def _get_row(number):
@@ -189,11 +458,11 @@ class RTM():
     def _get_col(number):
         return 7 - number % 8
 
-    def _display_simple_tasks(self, overdue, today, future):
+    def _display_simple_tasks(self, frame, overdue, today, future):
         current_pos = -1
         for i in range(overdue):
             current_pos += 1
-            self._matrix.set_pixel(self._get_row(current_pos), self._get_col(current_pos), BicolorMatrix8x8.RED)
+            frame.set_pixel(self._get_row(current_pos), self._get_col(current_pos), hardware.RED)
 
         # Fast forward to next row
         while (current_pos + 1) % 8 > 0:
@@ -201,7 +470,7 @@ class RTM():
 
         for i in range(today):
             current_pos += 1
-            self._matrix.set_pixel(self._get_row(current_pos), self._get_col(current_pos), BicolorMatrix8x8.YELLOW)
+            frame.set_pixel(self._get_row(current_pos), self._get_col(current_pos), hardware.YELLOW)
 
         # Fast forward to next row
         while (current_pos + 1) % 8 > 0:
@@ -209,27 +478,23 @@ class RTM():
 
         for i in range(future):
             current_pos += 1
-            self._matrix.set_pixel(self._get_row(current_pos), self._get_col(current_pos), BicolorMatrix8x8.GREEN)
+            frame.set_pixel(self._get_row(current_pos), self._get_col(current_pos), hardware.GREEN)
 
     @staticmethod
     def _calc_line_count(count):
         return math.ceil(count / 8)
 
-    def _draw_tasks(self, overdue, today, future):
+    def _draw_tasks(self, frame, overdue, today, future):
         overdue_lines = self._calc_line_count(overdue)
         today_lines = self._calc_line_count(today)
         future_lines = self._calc_line_count(future)
 
-        self._matrix.clear()
-
         if overdue_lines + today_lines + future_lines > 8:
-            self._display_binary_tasks(overdue, 7, BicolorMatrix8x8.RED)
-            self._display_binary_tasks(today, 4, BicolorMatrix8x8.YELLOW)
-            self._display_binary_tasks(future, 1, BicolorMatrix8x8.GREEN)
+            self._display_binary_tasks(frame, overdue, 7, hardware.RED)
+            self._display_binary_tasks(frame, today, 4, hardware.YELLOW)
+            self._display_binary_tasks(frame, future, 1, hardware.GREEN)
         else:
-            self._display_simple_tasks(overdue, today, future)
-
-        self._matrix.write_display()
+            self._display_simple_tasks(frame, overdue, today, future)
 
 
     def _midnight(self, date_object):
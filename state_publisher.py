@@ -0,0 +1,80 @@
+import json
+import os
+import socket
+from threading import Lock, Thread
+import traceback
+
+
+class StatePublisher():
+    # Shares values such as the task count with other parts of the program
+    # and with other processes. Files are only rewritten when a value
+    # changes, and always via a rename so readers never see a partial file.
+    # If a socket path is configured, each connection to it is sent all the
+    # current values as a JSON object.
+
+    def __init__(self, config=None):
+        config = config if config is not None else dict()
+
+        self._values = dict()
+        self._files = dict()
+        self._lock = Lock()
+
+        if config.get('socket'):
+            Thread(target=self._serve, args=(config['socket'], ), daemon=True).start()
+
+    def publish(self, name, value, file=None):
+        with self._lock:
+            if self._values.get(name) == value:
+                return
+
+            self._values[name] = value
+            if file is not None:
+                self._files[file] = name
+                # Under the lock, so two publishes can't share the temp file
+                # or land out of order
+                self._write_file(file, value)
+
+    def get(self, name):
+        return self._values.get(name)
+
+    def file_value(self, file):
+        # The value last written to a file we publish, without reading it
+        name = self._files.get(file)
+        return None if name is None else self._values.get(name)
+
+    @staticmethod
+    def _write_file(file, value):
+        text = f'{value}'
+
+        try:
+            with open(file) as current:
+                if current.read() == text:
+                    return
+        except OSError:
+            pass
+
+        try:
+            temp_file = f'{file}.tmp'
+            with open(temp_file, 'w') as out:
+                out.write(text)
+            os.replace(temp_file, file)
+        except OSError:
+            print(traceback.format_exc())
+
+    def _serve(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server_socket:
+            server_socket.bind(path)
+            server_socket.listen()
+
+            while True:
+                conn, addr = server_socket.accept()
+                with conn:
+                    try:
+                        with self._lock:
+                            data = json.dumps(self._values)
+                        conn.sendall(f'{data}\n'.encode('utf-8'))
+                    except OSError:
+                        pass
@@ -0,0 +1,65 @@
+import glob
+import os
+import tempfile
+import unittest
+
+from dir_counter import DirCounter
+
+
+class DirCounterTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.root = self._dir.name
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def touch(self, *parts):
+        open(self.path(*parts), 'w').close()
+
+    def expected(self):
+        # What DirCounter stands in for, less the root itself
+        return len(glob.glob(os.path.join(self.root, '**'), recursive=True)) - 1
+
+    def counter(self):
+        counter = DirCounter(self.root)
+        self.addCleanup(counter.close)
+        return counter
+
+    def test_counts_changes(self):
+        os.makedirs(self.path('a', 'b'))
+        self.touch('a', 'x')
+        counter = self.counter()
+        self.assertEqual(counter.count(), self.expected())
+
+        self.touch('a', 'b', 'y')
+        os.remove(self.path('a', 'x'))
+        os.mkdir(self.path('c'))
+        self.assertEqual(counter.count(), self.expected())
+
+    def test_move_within_tree(self):
+        # The destination parent is rescanned before the source, so the
+        # moved directory's watch is taken over before the old path goes
+        os.makedirs(self.path('aaaa', 'x', 'y'))
+        os.mkdir(self.path('b'))
+        counter = self.counter()
+        self.assertEqual(counter.count(), self.expected())
+
+        os.rename(self.path('aaaa', 'x'), self.path('b', 'x'))
+        self.assertEqual(counter.count(), self.expected())
+
+        for i in range(4):
+            self.touch('b', 'x', f'file{i}')
+        self.assertEqual(counter.count(), self.expected())
+
+        os.mkdir(self.path('b', 'x', 'y', 'z'))
+        self.assertEqual(counter.count(), self.expected())
+
+    def test_missing_path(self):
+        with self.assertRaises(FileNotFoundError):
+            DirCounter(self.path('missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import threading
+import unittest
+from unittest import mock
+
+from url_cache import UrlCache
+
+
+class FakeResponse():
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or dict()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f'HTTP {self.status_code}')
+
+
+class FakeSession():
+    # Serves a new version of the body on every unconditional request, or
+    # whenever the version has moved on since the ETag the client sent. If
+    # gate is set to an Event, requests wait for it after setting started.
+    def __init__(self):
+        self.version = 0
+        self.requests = 0
+        self.fail = False
+        self.gate = None
+        self.started = threading.Event()
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests += 1
+        if self.gate is not None:
+            self.started.set()
+            self.gate.wait()
+        if self.fail:
+            raise ConnectionError('down')
+
+        etag = f'"{self.version}"'
+        if (headers or dict()).get('If-None-Match') == etag:
+            return FakeResponse(304)
+        return FakeResponse(200, str(self.version), {'ETag': etag})
+
+
+class UrlCacheTest(unittest.TestCase):
+    URL = 'http://example.com/count'
+
+    def setUp(self):
+        self.now = 1000.0
+        self.session = FakeSession()
+        self.cache = UrlCache()
+        self.cache._sessions['example.com'] = self.session
+
+    def poll(self, max_age=10):
+        with mock.patch('time.monotonic', lambda: self.now):
+            return self.cache.get(self.URL, max_age=max_age)
+
+    def test_polling_on_schedule_gets_the_current_body(self):
+        # A counter is polled just over max_age after its last fetch finished
+        for version in range(5):
+            self.session.version = version
+            self.assertEqual(self.poll(), str(version))
+            self.now += 10.5
+
+        self.assertEqual(self.cache.stale_hits, 0)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_unchanged_body_is_revalidated(self):
+        self.poll()
+        self.now += 10.5
+        self.assertEqual(self.poll(), '0')
+        self.assertEqual(self.cache.revalidated, 1)
+
+    def test_counters_sharing_a_url_share_a_fetch(self):
+        self.poll()
+        self.now += 2
+        self.poll()
+        self.assertEqual(self.session.requests, 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_failed_fetch_serves_stale_body_for_one_more_interval(self):
+        self.poll()
+        self.session.fail = True
+        self.now += 15
+        self.assertEqual(self.poll(), '0')
+        self.assertEqual(self.cache.stale_hits, 1)
+
+        self.now += 10
+        with self.assertRaises(ConnectionError):
+            self.poll()
+
+    def test_fetch_does_not_block_other_callers(self):
+        self.poll()
+        self.now += 15
+        self.session.version = 1
+        self.session.gate = threading.Event()
+        self.addCleanup(self.session.gate.set)
+        results = dict()
+
+        def poll(name):
+            results[name] = self.cache.get(self.URL, max_age=10)
+
+        # Patched for every thread until the end of the test
+        with mock.patch('time.monotonic', lambda: self.now):
+            slow = threading.Thread(target=poll, args=('slow', ), daemon=True)
+            slow.start()
+            self.assertTrue(self.session.started.wait(5))
+
+            # Served the body we have while the slow fetch is still waiting.
+            # The join timeout only stops a regression from hanging the run.
+            other = threading.Thread(target=poll, args=('other', ), daemon=True)
+            other.start()
+            other.join(5)
+            self.assertFalse(other.is_alive())
+            self.assertTrue(slow.is_alive())
+            self.assertEqual(results['other'], '0')
+            self.assertEqual(self.session.requests, 2)
+
+            self.session.gate.set()
+            slow.join(5)
+            self.assertEqual(results['slow'], '1')
+            self.assertEqual(self.cache.get(self.URL, max_age=10), '1')
+
+
+if __name__ == '__main__':
+    unittest.main()
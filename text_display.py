@@ -1,77 +1,95 @@
-import board
-from adafruit_ht16k33.segments import Seg14x4
+from compositor import Compositor
+import hardware
 import toml
-import re
 import time
-from threading import Thread, Event
 
 
 class text_display():
     SCROLL_DELAY = 0.2
-
-    def __init__(self, config):
-        i2c = board.I2C()
-        self._display = Seg14x4(i2c, address=config['address'])
-        self._display.brightness = config['brightness']
-        
-        self._scroll_event = None
-        self.clear()
-
-    def clear(self):
-        self._stop_scroll()
-        self._display.print('    ')
-
-    def write(self, text):
-        self._stop_scroll()
-        text = text.strip().upper()
-
-        no_dots = re.sub(r'\.', '', text)
-        text = text + ' ' * (4 - len(no_dots))
-
-        if len(re.sub(r'\.', '', text)) <= 4:
-            self._display.print(text)
+    DIGITS = 4
+    BLANK = 0
+    DOT = 16384
+    BLANK_FRAME = (BLANK, ) * DIGITS
+
+    # Raw 14 segment bitmask for each printable character, as used by
+    # Seg14x4.print, built on first use
+    GLYPHS = None
+
+    def __init__(self, config, compositor=None):
+        self._display = hardware.create_segments(config)
+        self._display.set_brightness(config['brightness'])
+
+        self._shown = None
+        self.push(self.BLANK_FRAME)
+
+        # All writes to the display happen on the compositor's render thread
+        self._compositor = compositor if compositor is not None else Compositor()
+        self._compositor.add_device(self)
+
+    def clear(self, layer=Compositor.COUNTER):
+        self._compositor.release(self, layer)
+
+    def write(self, text, layer=Compositor.COUNTER):
+        frames = self.compile(text)
+        self._compositor.submit(self, layer, frames, self.SCROLL_DELAY)
+
+    def rotate(self, texts, hold, layer=Compositor.COUNTER, keys=None):
+        # Cycle through several texts, holding short ones for hold seconds
+        # and scrolling long ones through once each. keys identify the
+        # texts, in order, so that a new set carries on from the one showing.
+        keys = keys if keys is not None else range(len(texts))
+        frames = list()
+        periods = list()
+        items = list()
+        for key, text in zip(keys, texts):
+            text_frames = self.compile(text)
+            frames.extend(text_frames)
+            periods.extend([hold] if len(text_frames) == 1 else [self.SCROLL_DELAY] * len(text_frames))
+            items.extend([key] * len(text_frames))
+
+        if len(frames) == 0:
+            self._compositor.release(self, layer)
         else:
-            self._scroll_text(text)
-
-    def dots(self, count):
-        self.clear()
-        if count >= 1:
-            self._display.set_digit_raw(0, 16384)
-        if count >= 2:
-            self._display.set_digit_raw(1, 16384)
-        if count >= 3:
-            self._display.set_digit_raw(2, 16384)
-        if count >= 4:
-            self._display.set_digit_raw(3, 16384)
-
-    def _scroll_text(self, text):
-        Thread(target=self._scroll_animation, args=(text,)).start()
-
-    def _scroll_animation(self, text):
-        self._scroll_event = Event()
-
-        # Front padding
-        text = '   ' + text + '   '
-
-        pos = 0
-        while not self._scroll_event.is_set():
-            print_start = pos
-            print_end = pos + 4
-
-            self._display.print(text[print_start:print_end])
-            time.sleep(self.SCROLL_DELAY)
-
-            if pos >= len(text):
-                pos = 0
+            self._compositor.submit(self, layer, frames, periods, items)
+
+    def dots(self, count, layer=Compositor.COUNTER):
+        self._compositor.submit(self, layer, [tuple(self.DOT if digit < count else self.BLANK for digit in range(self.DIGITS))])
+
+    @classmethod
+    def compile(cls, text):
+        # Turn a message into the list of raw digit frames needed to show it,
+        # so scrolling doesn't have to map characters to segments every step
+        if cls.GLYPHS is None:
+            chars = hardware.segment_chars()
+            cls.GLYPHS = {chr(code): (chars[code * 2 - 64] << 8) | chars[code * 2 - 63] for code in range(32, 128)}
+
+        cells = list()
+        for char in text.strip().upper():
+            if char == '.':
+                # A dot lights the decimal point of the character before it
+                if len(cells) == 0 or cells[-1] & cls.DOT:
+                    cells.append(cls.BLANK)
+                cells[-1] |= cls.DOT
             else:
-                pos += 1
+                cells.append(cls.GLYPHS.get(char, cls.BLANK))
 
-        self._scroll_event = None
+        if len(cells) <= cls.DIGITS:
+            return [tuple(cells + [cls.BLANK] * (cls.DIGITS - len(cells)))]
 
-    def _stop_scroll(self):
-        if self._scroll_event is not None:
-            self._scroll_event.set()
-            time.sleep(self.SCROLL_DELAY)
+        # Scroll in from the right and out to the left
+        padding = [cls.BLANK] * (cls.DIGITS - 1)
+        cells = padding + cells + padding + [cls.BLANK] * cls.DIGITS
+        return [tuple(cells[pos:pos + cls.DIGITS]) for pos in range(len(cells) - cls.DIGITS + 1)]
+
+    def push(self, frame):
+        # Called from the compositor's render thread only
+        if frame != self._shown:
+            for digit in range(self.DIGITS):
+                if self._shown is None or frame[digit] != self._shown[digit]:
+                    self._display.set_digit_raw(digit, frame[digit])
+
+            self._display.show()
+            self._shown = frame
 
 
 if __name__ == "__main__":
@@ -92,6 +110,3 @@ if __name__ == "__main__":
             text.dots(count)
             time.sleep(0.25)
             count -= 1
-
-        
-
@@ -1,67 +1,125 @@
-from alerts import Alerts
-import json
+import alert_client
+import logging
+import metrics
 import os
 import requests
-import socket
-import sys
+from requests.adapters import HTTPAdapter
+from threading import Event, Thread
 import toml
 import traceback
-from urllib.parse import parse_qs
-
-def get_incidents(api_key):
-  url = 'https://api.uptimerobot.com/v3/incidents'
-
-  payload = 'cursor=1'
-  headers = {
-    'accept': 'application/json',
-    'authorization': f'Bearer {api_key}'
-  }
-
-  response = requests.request('GET', url, data=payload, headers=headers)
-  if response.status_code != 200:
-    raise Exception("HTTP ERROR " + str(response.status_code))
-
-  data = json.loads(response.text)
-  if 'message' in data.keys():
-    raise Exception(f'API call failed: {data["message"]}')
-
-  return data['data']
-
-
-with open('config.toml') as config_file:
-    config = toml.load(config_file)
-
-api_key = config['uptime_robot']['api_key']
-alert_port = config['alerts']['port']
-
-stored_last_incident = None
-
-if os.path.exists('last_incident.txt'):
-    with open('last_incident.txt') as incident_file:
-        stored_last_incident = incident_file.read()
-
-incidents = get_incidents(api_key)
-
-api_last_incident = None
-
-for incident in incidents:
-    # Keep the first incident ID to be stored.
-    if api_last_incident is None:
-        api_last_incident = incident['id']
-
-    # If we hit the previous last incident ID, stop
-    if incident['id'] == stored_last_incident:
-        break
-
-    # If the incident is not resolved, raise an alert
-    if incident['resolvedAt'] is None:
-        monitor_name = incident['monitor']['friendlyName']
-
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(('localhost', alert_port))
-            msg = f'{Alerts.RED} {monitor_name} down'
-            s.sendall(str.encode(msg))
-            print(s.recv(1024).decode())
-
-with open('last_incident.txt', 'w') as incident_file:
-    incident_file.write(api_last_incident)
+from urllib3.util.retry import Retry
+
+
+class UptimeRobot():
+    # Polls UptimeRobot for new incidents and raises an alert for each
+    # monitor that is still down. send_alerts takes a list of (colour,
+    # message) pairs, like AlertClient.send_many.
+    INCIDENTS_URL = 'https://api.uptimerobot.com/v3/incidents'
+    POLL_INTERVAL = 60
+    INCIDENT_FILE = 'last_incident.txt'
+    TIMEOUT = (10, 30)
+
+    # Only matters when we have no last incident to page back to
+    MAX_PAGES = 10
+
+    def __init__(self, config, send_alerts, start=True):
+        self._send_alerts = send_alerts
+        self._poll_interval = config.get('poll_interval', self.POLL_INTERVAL)
+        self._incident_file = config.get('incident_file', self.INCIDENT_FILE)
+
+        self._session = requests.Session()
+        self._session.headers.update({
+            'accept': 'application/json',
+            'authorization': f'Bearer {config["api_key"]}'
+        })
+        adapter = HTTPAdapter(max_retries=Retry(connect=5, backoff_factor=0.5), pool_connections=1, pool_maxsize=1)
+        self._session.mount('https://', adapter)
+
+        self._last_incident = None
+        if os.path.exists(self._incident_file):
+            with open(self._incident_file) as incident_file:
+                self._last_incident = incident_file.read().strip() or None
+
+        self._stop = Event()
+        if start:
+            Thread(target=self._run, name='uptime_robot', daemon=True).start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+            self._stop.wait(self._poll_interval)
+
+    def close(self):
+        self._stop.set()
+        self._session.close()
+
+    def poll(self):
+        down_alerts = list()
+        newest_incident = None
+
+        for incident in self._new_incidents():
+            # Keep the first incident ID to be stored
+            if newest_incident is None:
+                newest_incident = str(incident['id'])
+
+            # If the incident is not resolved, raise an alert
+            if incident['resolvedAt'] is None:
+                monitor_name = incident['monitor']['friendlyName']
+                down_alerts.append((alert_client.RED, f'{monitor_name} down'))
+
+        if len(down_alerts) > 0:
+            for response in self._send_alerts(down_alerts):
+                if response != 'OK':
+                    logging.error(f'UptimeRobot alert not accepted: {response}')
+
+        if newest_incident is not None and newest_incident != self._last_incident:
+            self._last_incident = newest_incident
+            self._save_last_incident()
+
+    def _new_incidents(self):
+        # Incidents come newest first, so page back until we reach the
+        # last one we've seen
+        url = self.INCIDENTS_URL
+        pages = 0
+
+        while url is not None and pages < self.MAX_PAGES:
+            with metrics.timer('uptime_robot_request_seconds'):
+                response = self._session.get(url, timeout=self.TIMEOUT)
+            if response.status_code != 200:
+                raise Exception("HTTP ERROR " + str(response.status_code))
+
+            data = response.json()
+            if 'message' in data.keys():
+                raise Exception(f'API call failed: {data["message"]}')
+
+            for incident in data['data']:
+                if str(incident['id']) == self._last_incident:
+                    return
+                yield incident
+
+            url = data.get('nextLink')
+            pages += 1
+
+    def _save_last_incident(self):
+        try:
+            temp_file = f'{self._incident_file}.tmp'
+            with open(temp_file, 'w') as incident_file:
+                incident_file.write(f'{self._last_incident}')
+            os.replace(temp_file, self._incident_file)
+        except OSError:
+            logging.error(traceback.format_exc())
+
+
+if __name__ == "__main__":
+    # Check once and send any alerts to a running program, as from cron
+    with open('config.toml') as config_file:
+        config = toml.load(config_file)
+
+    with alert_client.AlertClient('localhost', config['alerts']['port']) as client:
+        uptime_robot = UptimeRobot(config['uptime_robot'], client.send_many, start=False)
+        uptime_robot.poll()
+        uptime_robot.close()
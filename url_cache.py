@@ -0,0 +1,154 @@
+from collections import OrderedDict
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from threading import Lock
+import time
+import traceback
+from urllib.parse import urlsplit
+
+
+class UrlCache():
+    MAX_ENTRIES = 64
+    POOL_SIZE = 2
+    TIMEOUT = 10
+
+    # Share of max_age for which a fetched body is reused without checking
+    FRESH_FRACTION = 0.5
+
+    def __init__(self, max_entries=MAX_ENTRIES, pool_size=POOL_SIZE):
+        self._max_entries = max_entries
+        self._pool_size = pool_size
+
+        self._entries = OrderedDict()
+        self._sessions = dict()
+        self._lock = Lock()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def get(self, url, headers=None, max_age=0, timeout=TIMEOUT):
+        # max_age is how often callers poll the URL. A body is only reused
+        # within the first part of that, which covers several counters
+        # reading the same URL, so a caller polling on schedule always gets
+        # a freshly checked body. Conditional requests keep that cheap.
+        entry = self._entry(url, headers)
+
+        with entry['lock']:
+            age = None if entry['fetched'] is None else time.monotonic() - entry['fetched']
+            usable = age is not None and age <= max_age * 2
+
+            if age is not None and age <= max_age * self.FRESH_FRACTION:
+                self.hits += 1
+                return entry['response']
+            elif usable and entry['refreshing']:
+                # Another caller is already fetching it, so don't wait for them
+                self.stale_hits += 1
+                return entry['response']
+
+            self.misses += 1
+            entry['refreshing'] = True
+            validators = (entry['etag'], entry['last_modified'])
+
+        # Fetch without holding the entry lock, so other callers can be
+        # served the body we have meanwhile
+        try:
+            response = self._fetch(url, headers, validators, timeout)
+            if response.status_code != 304:
+                response.raise_for_status()
+        except Exception:
+            with entry['lock']:
+                entry['refreshing'] = False
+                if not usable:
+                    raise
+
+                # Fall back to the body we have for up to one more interval
+                self.stale_hits += 1
+                print(traceback.format_exc())
+                return entry['response']
+
+        with entry['lock']:
+            entry['refreshing'] = False
+            if response.status_code == 304 and entry['response'] is not None:
+                self.revalidated += 1
+            else:
+                entry['response'] = response.text
+                entry['etag'] = response.headers.get('ETag')
+                entry['last_modified'] = response.headers.get('Last-Modified')
+
+            entry['fetched'] = time.monotonic()
+            return entry['response']
+
+    def get_json(self, url, headers=None, max_age=0, timeout=TIMEOUT):
+        entry = self._entry(url, headers)
+        text = self.get(url, headers, max_age, timeout)
+
+        # Parse once per fetched body, however many counters read it
+        with entry['lock']:
+            if entry['json_source'] is not text:
+                entry['json'] = json.loads(text)
+                entry['json_source'] = text
+
+            return entry['json']
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated
+        }
+
+    def _entry(self, url, headers):
+        # The same URL with different headers can return different content
+        key = (url, tuple(sorted(headers.items())) if headers else ())
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                self._entries[key] = {
+                    'fetched': None,
+                    'response': None,
+                    'json': None,
+                    'json_source': None,
+                    'etag': None,
+                    'last_modified': None,
+                    'refreshing': False,
+                    'lock': Lock()
+                }
+
+                while len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+
+            return self._entries[key]
+
+    def _session(self, url):
+        host = urlsplit(url).netloc
+
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+
+            return self._sessions[host]
+
+    def _fetch(self, url, headers, validators, timeout):
+        etag, last_modified = validators
+        request_headers = dict(headers) if headers else dict()
+        if etag is not None:
+            request_headers['If-None-Match'] = etag
+        if last_modified is not None:
+            request_headers['If-Modified-Since'] = last_modified
+
+        return self._session(url).get(url, headers=request_headers, timeout=timeout)
+
+    def close(self):
+        for session in self._sessions.values():
+            session.close()